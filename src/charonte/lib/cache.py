@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+DEFAULT_TTL = 24 * 60 * 60
+NO_FACT_CACHE_ENV = "CHARONTE_NO_FACT_CACHE"
+
+
+def cache_root() -> Path:
+    root = os.environ.get("CHARONTE_CACHE_DIR")
+    if root:
+        return Path(root)
+    xdg_cache = os.environ.get("XDG_CACHE_HOME") or str(Path.home() / ".cache")
+    return Path(xdg_cache) / "charonte"
+
+
+class FactCache:
+    """
+    Controller-side, on-disk cache of host facts.
+
+    Entries are stored per host and are only returned while the fingerprint
+    they were stored with still matches the one reported by the host and
+    they are younger than the TTL.
+    """
+
+    def __init__(
+        self, namespace: str, ttl: int = DEFAULT_TTL, root: Path | None = None
+    ):
+        self.ttl = ttl
+        self.directory = (root or cache_root()) / namespace
+        self._evicted = False
+
+    def _path(self, key: str) -> Path:
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+        return self.directory / f"{digest}.json"
+
+    def _is_expired(self, stored_at: float) -> bool:
+        return time.time() - stored_at > self.ttl
+
+    def get(self, key: str, fingerprint: str) -> Any | None:
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if entry.get("key") != key or entry.get("fingerprint") != fingerprint:
+            return None
+        if self._is_expired(entry.get("stored_at", 0)):
+            return None
+        return entry.get("data")
+
+    def set(self, key: str, fingerprint: str, data: Any) -> None:
+        entry = {
+            "key": key,
+            "fingerprint": fingerprint,
+            "stored_at": time.time(),
+            "data": data,
+        }
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            return
+
+        if not self._evicted:
+            self.evict()
+
+    def invalidate(self, key: str) -> None:
+        try:
+            self._path(key).unlink()
+        except OSError:
+            pass
+
+    def evict(self) -> int:
+        """
+        Removes every expired entry of the namespace, returning how many were removed.
+        """
+        self._evicted = True
+        removed = 0
+        try:
+            paths = list(self.directory.glob("*.json"))
+        except OSError:
+            return removed
+
+        for path in paths:
+            try:
+                if self._is_expired(path.stat().st_mtime):
+                    path.unlink()
+                    removed += 1
+            except OSError:
+                continue
+        return removed
+
+
+def get_fact_cache(
+    namespace: str, options: Any = None, default_ttl: int = DEFAULT_TTL
+) -> FactCache | None:
+    """
+    Builds the fact cache for a role from its `factCache` ChObolo option.
+
+    The option may be a boolean or a mapping with `enabled` and `ttl` keys;
+    setting CHARONTE_NO_FACT_CACHE in the environment disables every cache.
+    """
+    if os.environ.get(NO_FACT_CACHE_ENV):
+        return None
+
+    if options is None:
+        options = {}
+    elif isinstance(options, bool):
+        options = {"enabled": options}
+
+    if not options.get("enabled", True):
+        return None
+
+    try:
+        ttl = int(options.get("ttl", default_ttl))
+    except (TypeError, ValueError):
+        ttl = default_ttl
+
+    return FactCache(namespace, ttl=ttl)
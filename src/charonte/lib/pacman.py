@@ -0,0 +1,331 @@
+import shlex
+from dataclasses import dataclass, field
+from weakref import WeakKeyDictionary
+
+from pyinfra import context
+from pyinfra.api import operation
+from pyinfra.api.operation import add_op
+from pyinfra.operations import server
+
+PACMAN_FLAGS = ["--noconfirm", "--noprogressbar"]
+PREFETCH_LOCK = "/run/charonte-prefetch.lock"
+# The download holds the lock for as long as it holds pacman's own. Ops that
+# take pacman's lock outside the transaction (makepkg -s, AUR helpers, -U of
+# built packages) always start with this, as their role may be planned before
+# the one queuing the download. A missing lock means no download started, and
+# unprivileged ops could not create it anyway.
+PREFETCH_WAIT = (
+    f"! command -v flock >/dev/null || [ ! -e {PREFETCH_LOCK} ] || "
+    f"flock {PREFETCH_LOCK} true"
+)
+# pyinfra runs every command as a single `sh -c` argument, which Linux caps
+# at 128 KiB, and a smaller transaction loses less when one target is bad.
+CHUNK_MAX_BYTES = 32 * 1024
+CHUNK_MAX_TARGETS = 250
+
+
+def chunk_targets(
+    targets: list[str],
+    max_targets: int | None = CHUNK_MAX_TARGETS,
+    max_bytes: int = CHUNK_MAX_BYTES,
+) -> list[list[str]]:
+    """
+    Splits `targets` into chunks of at most `max_targets` entries whose joined
+    length stays under `max_bytes`.
+    """
+    chunks: list[list[str]] = []
+    chunk: list[str] = []
+    size = 0
+    for target in targets:
+        full = max_targets is not None and len(chunk) >= max_targets
+        if chunk and (full or size + len(target) + 1 > max_bytes):
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(target)
+        size += len(target) + 1
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def chunked_commands(
+    command: list[str],
+    targets: list[str],
+    max_targets: int | None = CHUNK_MAX_TARGETS,
+    quote: bool = True,
+    installed_only: bool = False,
+) -> list[str]:
+    """
+    Builds one timed `command` invocation per chunk of `targets`.
+
+    Each chunk is its own transaction, so the chunks before a failing one stay
+    applied. With `installed_only`, targets that are not installed under that
+    exact name (removed by the cascade of an earlier chunk, or virtual names
+    only provided by another package) are skipped.
+    """
+    if quote:
+        targets = [shlex.quote(target) for target in targets]
+    chunks = chunk_targets(targets, max_targets)
+    label = " ".join(command[:2])
+
+    commands = []
+    for index, chunk in enumerate(chunks, start=1):
+        if installed_only:
+            invocation = (
+                f"pacman -Qq {' '.join(chunk)} 2>/dev/null | grep -Fx "
+                + " ".join(f"-e {target}" for target in chunk)
+                + f" | xargs -r {' '.join(command)}"
+            )
+        else:
+            invocation = " ".join([*command, *chunk])
+        report = f"{label}: chunk {index}/{len(chunks)}, {len(chunk)} targets"
+        commands.append(
+            "started=$(date +%s); "
+            f"{invocation} || "
+            f'{{ echo "{report} failed after $(($(date +%s) - started))s" >&2; '
+            "exit 1; }; "
+            f'echo "{report} in $(($(date +%s) - started))s"'
+        )
+    return commands
+
+
+@dataclass
+class _Contribution:
+    seq: int
+    kind: str
+    targets: list[str]
+    flags: str = ""
+
+
+@dataclass
+class PacmanTransaction:
+    """
+    Pacman work contributed by several roles for one host.
+
+    Every contribution is tagged with the number of flushes registered before
+    it. At execution time only flushes that other ops follow (and explicit
+    barriers) run the pending contributions, so roles whose flushes are
+    adjacent share one install, one -U and one removal per set of flags
+    instead of each paying for its own lock, dependency resolution and hooks,
+    while an op added after a flush still finds its packages installed.
+    """
+
+    contributions: list[_Contribution] = field(default_factory=list)
+    flushes: int = 0
+    consumed: int = 0
+    prefetching: bool = False
+    # Number of ops of the host right after each flush's own op.
+    flush_ops: dict[int, int] = field(default_factory=dict)
+    barriers: set[int] = field(default_factory=set)
+
+    def contribute(self, kind: str, targets: list[str], flags: str = "") -> None:
+        if targets:
+            self.contributions.append(
+                _Contribution(self.flushes, kind, list(targets), flags)
+            )
+
+    def register_flush(self, ops: int = 0) -> int:
+        """
+        Registers a flush when the host has `ops` operations. The previous
+        flush becomes a barrier if any op was added since its own.
+        """
+        if ops > self.flush_ops.get(self.flushes, ops):
+            self.barriers.add(self.flushes)
+        self.flushes += 1
+        return self.flushes
+
+    def runs(self, token: int, barrier: bool = False) -> bool:
+        return barrier or token == self.flushes or token in self.barriers
+
+    def pending(self, token: int) -> list[_Contribution]:
+        return [c for c in self.contributions[self.consumed :] if c.seq < token]
+
+    def commands(self, contributions: list[_Contribution]) -> list[str]:
+        install: list[str] = []
+        install_deps: list[str] = []
+        upgrade: list[str] = []
+        remove: dict[str, list[str]] = {}
+        orphans: list[str] = []
+        mark_explicit: list[str] = []
+        mark_deps: list[str] = []
+
+        for contribution in contributions:
+            if contribution.kind == "install":
+                install.extend(contribution.targets)
+            elif contribution.kind == "install_deps":
+                install_deps.extend(contribution.targets)
+            elif contribution.kind == "upgrade":
+                upgrade.extend(contribution.targets)
+            elif contribution.kind == "remove":
+                remove.setdefault(contribution.flags, []).extend(contribution.targets)
+            elif contribution.kind == "remove_orphans":
+                orphans.extend(contribution.targets)
+            elif contribution.kind == "mark_explicit":
+                mark_explicit.extend(contribution.targets)
+            elif contribution.kind == "mark_deps":
+                mark_deps.extend(contribution.targets)
+
+        commands = []
+        if self.prefetching:
+            # Even an empty barrier waits, as the ops after it may use pacman.
+            commands.append(PREFETCH_WAIT)
+        explicit = list(dict.fromkeys(install))
+        as_deps = [pkg for pkg in dict.fromkeys(install_deps) if pkg not in explicit]
+        commands.extend(
+            chunked_commands(
+                ["pacman", "-S", "--needed", *PACMAN_FLAGS], explicit + as_deps
+            )
+        )
+        explicit_marks = list(dict.fromkeys(mark_explicit))
+        deps_marks = [
+            pkg
+            for pkg in dict.fromkeys(as_deps + mark_deps)
+            if pkg not in explicit_marks
+        ]
+        # Reasons only touch the local DB, so each is a single cheap call.
+        commands.extend(
+            chunked_commands(
+                ["pacman", "-D", "--asdeps"],
+                deps_marks,
+                max_targets=None,
+                installed_only=True,
+            )
+        )
+        commands.extend(
+            chunked_commands(
+                ["pacman", "-D", "--asexplicit"],
+                explicit_marks,
+                max_targets=None,
+                installed_only=True,
+            )
+        )
+        # Artifacts are shell substitutions expanding to the package files.
+        commands.extend(
+            chunked_commands(
+                ["pacman", "-U", "--needed", *PACMAN_FLAGS],
+                upgrade,
+                max_targets=None,
+                quote=False,
+            )
+        )
+        for flags, targets in remove.items():
+            # Removals are only split when the command would be too long, as
+            # a chunk may need to take dependants of another chunk with it.
+            commands.extend(
+                chunked_commands(
+                    ["pacman", flags, *PACMAN_FLAGS],
+                    list(dict.fromkeys(targets)),
+                    max_targets=None,
+                    installed_only=True,
+                )
+            )
+        if orphans:
+            # Only what is still an unneeded dependency once everything else
+            # has been installed is removed.
+            commands.append(
+                "pacman -Qqdt | grep -Fx "
+                + " ".join(f"-e {shlex.quote(pkg)}" for pkg in dict.fromkeys(orphans))
+                + f" | xargs -r pacman -Rns {' '.join(PACMAN_FLAGS)}"
+            )
+        return commands
+
+
+_transactions: "WeakKeyDictionary[object, dict[str, PacmanTransaction]]" = (
+    WeakKeyDictionary()
+)
+
+
+def get_transaction(state, host) -> PacmanTransaction:
+    transactions = _transactions.setdefault(state, {})
+    return transactions.setdefault(host.name, PacmanTransaction())
+
+
+@operation(is_idempotent=False)
+def transaction(token: int, barrier: bool = False):
+    """
+    Runs the pacman work queued for the current host, see `PacmanTransaction`.
+    """
+    pending_transaction = get_transaction(context.state, context.host)
+    if not pending_transaction.runs(token, barrier):
+        return
+
+    contributions = pending_transaction.pending(token)
+    if context.state.is_executing:
+        pending_transaction.consumed += len(contributions)
+    yield from pending_transaction.commands(contributions)
+
+
+def queue_install(state, host, packages: list[str]) -> None:
+    get_transaction(state, host).contribute("install", packages)
+
+
+def queue_install_deps(state, host, packages: list[str]) -> None:
+    get_transaction(state, host).contribute("install_deps", packages)
+
+
+def queue_upgrade(state, host, artifacts: list[str]) -> None:
+    get_transaction(state, host).contribute("upgrade", artifacts)
+
+
+def queue_remove(state, host, packages: list[str], flags: str = "-Rns") -> None:
+    get_transaction(state, host).contribute("remove", packages, flags)
+
+
+def queue_mark(state, host, packages: list[str], explicit: bool) -> None:
+    kind = "mark_explicit" if explicit else "mark_deps"
+    get_transaction(state, host).contribute(kind, packages)
+
+
+def queue_remove_orphans(state, host, packages: list[str]) -> None:
+    get_transaction(state, host).contribute("remove_orphans", packages)
+
+
+def prefetch_command(packages: list[str]) -> str:
+    """
+    Builds the command starting the download of `packages` into the pacman
+    cache in the background.
+    """
+    download = " ".join(
+        ["flock", PREFETCH_LOCK, "pacman", "-Sw", "--needed", *PACMAN_FLAGS]
+        + [shlex.quote(pkg) for pkg in packages]
+    )
+    return (
+        "command -v flock >/dev/null && "
+        f"(setsid nohup {download} >/dev/null 2>&1 &) || true"
+    )
+
+
+def start_prefetch(state, host, packages: list[str]) -> bool:
+    """
+    Queues an op downloading `packages` in the background, so the host's
+    flushes install from a warm cache. The download starts when the op runs,
+    never at plan time, so dry runs fetch nothing.
+    """
+    if not packages:
+        return False
+    add_op(
+        state,
+        server.shell,
+        name="Prefetching native packages",
+        commands=[prefetch_command(packages)],
+        _sudo=True,
+    )
+    get_transaction(state, host).prefetching = True
+    return True
+
+
+def flush_transaction(state, host, name: str, barrier: bool = False) -> None:
+    """
+    Registers a flush point for the host's pending pacman transaction.
+    """
+    pending_transaction = get_transaction(state, host)
+    token = pending_transaction.register_flush(len(host.op_hash_order))
+    add_op(
+        state,
+        transaction,
+        name=name,
+        token=token,
+        barrier=barrier,
+        _sudo=True,
+    )
+    pending_transaction.flush_ops[token] = len(host.op_hash_order)
@@ -4,7 +4,11 @@ from chaos.lib.args.dataclasses import Delta, ResultPayload
 from chaos.lib.roles.role import Role
 from pyinfra.api.operation import add_op
 from pyinfra.facts.files import File
-from pyinfra.operations import git, pacman, server
+from pyinfra.operations import git, server
+
+from charonte.lib import pacman
+
+PACKAGE_LIST = ".charonte-pkglist"
 
 
 class AurHelperRole(Role):
@@ -78,7 +82,7 @@ class AurHelperRole(Role):
         helpers_to_add = delta.to_add.get("aur_helpers", [])
         helpers_to_remove = delta.to_remove.get("aur_helpers", [])
 
-        command = "makepkg -sirc --noconfirm --needed"
+        command = "makepkg -src --noconfirm --needed"
 
         try:
             if helpers_to_add:
@@ -92,22 +96,26 @@ class AurHelperRole(Role):
                             src=repo,
                             dest=f"/tmp/{helper}",
                         )
+                    # makepkg refuses to run as root, so the package list is
+                    # written here for the privileged transaction to read.
                     add_op(
                         state,
                         server.shell,
-                        name=f"Build and install {helper}",
-                        commands=command,
+                        name=f"Build {helper}",
+                        commands=[
+                            pacman.PREFETCH_WAIT,
+                            f"{command} && makepkg --packagelist | "
+                            f"grep -v /{helper}-debug- > {PACKAGE_LIST}",
+                        ],
                         chdir=f"/tmp/{helper}",
                     )
+                    pacman.queue_upgrade(
+                        state, host, [f"$(cat /tmp/{helper}/{PACKAGE_LIST})"]
+                    )
 
-            if helpers_to_remove:
-                add_op(
-                    state,
-                    pacman.packages,
-                    packages=helpers_to_remove,
-                    present=False,
-                    _sudo=True,
-                )
+            pacman.queue_remove(state, host, helpers_to_remove, flags="-R")
+            if helpers_to_add or helpers_to_remove:
+                pacman.flush_transaction(state, host, name="Syncing AUR helpers")
 
             return ResultPayload(success=True, message=[], error=[], data={})
         except Exception as e:
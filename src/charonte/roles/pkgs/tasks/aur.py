@@ -0,0 +1,407 @@
+import http.client
+import json
+import re
+import shlex
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from typing import Any
+
+from charonte.lib.cache import FactCache
+
+AUR_RPC_URL = "https://aur.archlinux.org/rpc/v5/info"
+AUR_GIT_URL = "https://aur.archlinux.org"
+AUR_BUILD_ROOT = "/var/tmp/charonte-aur"
+AUR_PKGEXT = ".pkg.tar.zst"
+AUR_METADATA_TTL = 60 * 60
+RPC_BATCH_SIZE = 100
+DEPENDENCY_FIELDS = ("Depends", "MakeDepends", "CheckDepends")
+VCS_SUFFIXES = ("-git", "-svn", "-hg", "-bzr", "-darcs", "-fossil", "-cvs")
+
+# RPC answers are memoized for the whole run, so a fleet declaring the same
+# AUR packages only asks the AUR about each of them once.
+_rpc_memo: dict[str, dict[str, Any] | None] = {}
+
+
+def strip_version(dependency: str) -> str:
+    return re.split(r"[<>=]", dependency, maxsplit=1)[0].strip()
+
+
+def entry_dependencies(entry: dict[str, Any], fields=DEPENDENCY_FIELDS) -> set[str]:
+    return {strip_version(dep) for field in fields for dep in entry.get(field) or []}
+
+
+def is_vcs_package(name: str) -> bool:
+    return name.endswith(VCS_SUFFIXES)
+
+
+def _rpmvercmp(a: str, b: str) -> int:
+    if a == b:
+        return 0
+
+    one, two = 0, 0
+    while one < len(a) and two < len(b):
+        sep1, sep2 = one, two
+        while one < len(a) and not a[one].isalnum():
+            one += 1
+        while two < len(b) and not b[two].isalnum():
+            two += 1
+
+        if one >= len(a) or two >= len(b):
+            break
+        if one - sep1 != two - sep2:
+            return -1 if one - sep1 < two - sep2 else 1
+
+        start1, start2 = one, two
+        is_num = a[one].isdigit()
+        matches = str.isdigit if is_num else str.isalpha
+        while one < len(a) and matches(a[one]):
+            one += 1
+        while two < len(b) and matches(b[two]):
+            two += 1
+
+        segment1, segment2 = a[start1:one], b[start2:two]
+        if not segment2:
+            return 1 if is_num else -1
+
+        if is_num:
+            segment1 = segment1.lstrip("0")
+            segment2 = segment2.lstrip("0")
+            if len(segment1) != len(segment2):
+                return 1 if len(segment1) > len(segment2) else -1
+
+        if segment1 != segment2:
+            return 1 if segment1 > segment2 else -1
+
+    rest1, rest2 = a[one:], b[two:]
+    if not rest1 and not rest2:
+        return 0
+    if (not rest1 and not rest2[:1].isalpha()) or rest1[:1].isalpha():
+        return -1
+    return 1
+
+
+def _split_evr(version: str) -> tuple[str, str, str | None]:
+    epoch, _, rest = version.rpartition(":") if ":" in version else ("0", "", version)
+    pkgver, dash, pkgrel = rest.rpartition("-")
+    if not dash:
+        return epoch or "0", rest, None
+    return epoch or "0", pkgver, pkgrel
+
+
+def vercmp(a: str, b: str) -> int:
+    """
+    Compares two package versions the way pacman's vercmp does.
+    """
+    if a == b:
+        return 0
+    epoch1, ver1, rel1 = _split_evr(a)
+    epoch2, ver2, rel2 = _split_evr(b)
+
+    result = _rpmvercmp(epoch1, epoch2)
+    if result == 0:
+        result = _rpmvercmp(ver1, ver2)
+        if result == 0 and rel1 is not None and rel2 is not None:
+            result = _rpmvercmp(rel1, rel2)
+    return result
+
+
+def load_aur_snapshot(path: str) -> dict[str, dict[str, Any]]:
+    """
+    Loads AUR metadata from a local JSON file, either a saved RPC response or a
+    list/mapping of RPC entries, so AUR deltas can be computed offline.
+    """
+    with open(Path(path).expanduser(), encoding="utf-8") as f:
+        payload = json.load(f)
+
+    if isinstance(payload, dict) and "results" in payload:
+        payload = payload["results"]
+    if isinstance(payload, dict):
+        payload = list(payload.values())
+    return {entry["Name"]: entry for entry in payload if entry.get("Name")}
+
+
+def fetch_aur_info(
+    names: list[str],
+    snapshot: dict[str, dict[str, Any]] | None = None,
+    cache: FactCache | None = None,
+) -> dict[str, dict[str, Any]]:
+    """
+    Returns the AUR RPC info (the .SRCINFO derived metadata) of every name that
+    exists in the AUR. With a snapshot the AUR is never contacted; otherwise
+    answers are read from the cache first. Raises OSError/ValueError when the
+    AUR cannot be reached.
+    """
+    if snapshot is not None:
+        return {name: snapshot[name] for name in names if name in snapshot}
+
+    missing = [name for name in names if name not in _rpc_memo]
+    if cache:
+        for name in list(missing):
+            cached = cache.get(name, "rpc")
+            if cached is not None:
+                _rpc_memo[name] = cached or None
+                missing.remove(name)
+
+    for i in range(0, len(missing), RPC_BATCH_SIZE):
+        batch = missing[i : i + RPC_BATCH_SIZE]
+        query = urllib.parse.urlencode([("arg[]", name) for name in batch])
+        try:
+            with urllib.request.urlopen(
+                f"{AUR_RPC_URL}?{query}", timeout=30
+            ) as response:
+                payload = json.load(response)
+        except http.client.HTTPException as e:
+            # Truncated or malformed responses, e.g. IncompleteRead.
+            raise OSError(f"AUR RPC request failed: {e!r}") from e
+
+        found = {entry["Name"]: entry for entry in payload.get("results", [])}
+        for name in batch:
+            _rpc_memo[name] = found.get(name)
+            if cache:
+                cache.set(name, "rpc", found.get(name) or {})
+
+    return {name: _rpc_memo[name] for name in names if _rpc_memo.get(name)}
+
+
+def resolve_aur_closure(
+    targets: list[str],
+    installed: set[str],
+    snapshot: dict[str, dict[str, Any]] | None = None,
+    cache: FactCache | None = None,
+) -> dict[str, dict[str, Any]]:
+    """
+    Returns the metadata of the targets plus every AUR package they need to be
+    built that is not installed yet.
+    """
+    metadata: dict[str, dict[str, Any]] = {}
+    seen: set[str] = set()
+    pending = list(targets)
+
+    while pending:
+        batch = sorted(set(pending) - seen)
+        seen.update(batch)
+        info = fetch_aur_info(batch, snapshot, cache)
+        metadata.update(info)
+        pending = [
+            dep
+            for entry in info.values()
+            for dep in entry_dependencies(entry)
+            if dep not in seen and dep not in installed
+        ]
+
+    return metadata
+
+
+def plan_aur_builds(
+    targets: list[str],
+    metadata: dict[str, dict[str, Any]],
+    installed: set[str],
+    prebuilt: set[str] = frozenset(),
+) -> dict[str, Any] | None:
+    """
+    Orders the AUR builds needed by the targets into levels of pkgbases whose
+    dependencies were all built in earlier levels. Repo dependencies are only
+    collected for pkgbases that are not `prebuilt`, since pacman -U resolves
+    the runtime ones by itself.
+
+    Returns None when some target has no metadata or the graph has a cycle, so
+    the caller can fall back to the AUR helper.
+    """
+    if any(target not in metadata for target in targets):
+        return None
+
+    needed = set(targets)
+    pending = list(targets)
+    while pending:
+        for dep in entry_dependencies(metadata[pending.pop()]):
+            if dep in metadata and dep not in installed and dep not in needed:
+                needed.add(dep)
+                pending.append(dep)
+
+    packages: dict[str, list[str]] = {}
+    for name in sorted(needed):
+        pkgbase = metadata[name].get("PackageBase") or name
+        packages.setdefault(pkgbase, []).append(name)
+    base_of = {name: base for base, names in packages.items() for name in names}
+
+    requires: dict[str, set[str]] = {base: set() for base in packages}
+    needed_by: dict[str, set[str]] = {name: set() for name in base_of}
+    repo_deps: set[str] = set()
+    runtime_deps: set[str] = set()
+
+    for name, base in base_of.items():
+        entry = metadata[name]
+        for dep in entry_dependencies(entry):
+            if dep in base_of:
+                needed_by[dep].add(base)
+                if base_of[dep] != base:
+                    requires[base].add(base_of[dep])
+            elif dep not in installed and base not in prebuilt:
+                repo_deps.add(dep)
+        runtime_deps.update(entry_dependencies(entry, ("Depends",)))
+
+    levels: list[list[str]] = []
+    remaining = dict(requires)
+    while remaining:
+        ready = sorted(
+            base for base, reqs in remaining.items() if not reqs & remaining.keys()
+        )
+        if not ready:
+            return None
+        levels.append(ready)
+        for base in ready:
+            del remaining[base]
+
+    # Packages other builds depend on have to be installed before those builds
+    # start. Dependencies only needed within their own pkgbase (split packages
+    # of a target) go in right after their build too, as the final transaction
+    # only installs the targets; targets nothing else needs wait for it.
+    install_after = []
+    built: set[str] = set()
+    for level in levels:
+        built.update(level)
+        install_after.append(
+            sorted(
+                name
+                for base in level
+                for name in packages[base]
+                if name not in targets or needed_by[name] - built
+            )
+        )
+
+    return {
+        "targets": sorted(targets),
+        "levels": levels,
+        "packages": packages,
+        "install_after": install_after,
+        "repo_deps": sorted(repo_deps),
+        "make_deps": sorted(repo_deps - runtime_deps),
+    }
+
+
+class AurArtifactStore:
+    """
+    Controller-side store of built AUR packages.
+
+    Artifacts live under `<path>/<pkgbase>/<version>-<arch>-<makepkg.conf digest>/`,
+    so a host only reuses a package built for the same version, architecture
+    and build configuration. When `url` is set, the same directory is expected
+    to be served over HTTP and hosts download from it instead of having the
+    artifacts uploaded through their connection.
+    """
+
+    def __init__(self, path: str, url: str | None = None):
+        self.path = Path(path).expanduser()
+        self.url = url.rstrip("/") if url else None
+
+    @classmethod
+    def from_options(cls, options: Any) -> "AurArtifactStore | None":
+        if not options:
+            return None
+        if isinstance(options, str):
+            return cls(options)
+        path = options.get("path")
+        return cls(path, options.get("url")) if path else None
+
+    @staticmethod
+    def key(pkgbase: str, version: str, arch: str, conf_hash: str) -> str:
+        return f"{pkgbase}/{version.replace(':', '_')}-{arch}-{conf_hash[:16]}"
+
+    @staticmethod
+    def filename(name: str, version: str, arch: str) -> str:
+        return f"{name}-{version}-{arch}{AUR_PKGEXT}"
+
+    def local_path(self, key: str, filename: str) -> str:
+        return str(self.path / key / filename)
+
+    def remote_url(self, key: str, filename: str) -> str | None:
+        if not self.url:
+            return None
+        return f"{self.url}/{urllib.parse.quote(key)}/{urllib.parse.quote(filename)}"
+
+    def has(self, key: str, filenames: list[str]) -> bool:
+        return all((self.path / key / filename).is_file() for filename in filenames)
+
+    def size(self, key: str, filenames: list[str]) -> int:
+        return sum(
+            (self.path / key / filename).stat().st_size for filename in filenames
+        )
+
+
+def _artifact_pattern(name: str) -> str:
+    escaped = re.sub(r"([.+])", r"\\\1", name)
+    return shlex.quote(f"/{escaped}-[^-/]+-[^-/]+-[^-/]+[.]pkg[.]tar[^/]*$")
+
+
+def _artifact_patterns(names: list[str]) -> str:
+    return " ".join(f"-e {_artifact_pattern(name)}" for name in names)
+
+
+def build_level_command(pkgbases: list[str], jobs: int = 0) -> str:
+    """
+    Clones and builds the pkgbases of one level concurrently, at most `jobs` at
+    a time (one per core when `jobs` is 0), recording the artifacts built.
+    """
+    job_limit = str(jobs) if jobs > 0 else '"$(nproc)"'
+    makepkg = f"PKGDEST={AUR_BUILD_ROOT}/pkgs PKGEXT={AUR_PKGEXT} makepkg"
+    build_script = (
+        # Existing clones are refreshed instead of recreated, so the VCS
+        # sources makepkg keeps next to the PKGBUILD survive between builds.
+        'if [ -d "src/$1/.git" ]; then git -C "src/$1" fetch -q && '
+        'git -C "src/$1" reset -q --hard FETCH_HEAD; else rm -rf "src/$1" && '
+        f'git clone -q --depth 1 "{AUR_GIT_URL}/$1.git" "src/$1"; fi && '
+        'cd "src/$1" && '
+        f"{makepkg} --noconfirm --noprogressbar -cf && "
+        f'{makepkg} --packagelist > "{AUR_BUILD_ROOT}/lists/$1"'
+    )
+    return (
+        f"mkdir -p {AUR_BUILD_ROOT}/src {AUR_BUILD_ROOT}/pkgs "
+        f"{AUR_BUILD_ROOT}/lists && cd {AUR_BUILD_ROOT} && "
+        f"printf '%s\\n' {' '.join(pkgbases)} | "
+        f"xargs -r -P {job_limit} -I{{}} sh -c {shlex.quote(build_script)} _ {{}}"
+    )
+
+
+def select_artifacts(names: list[str]) -> str:
+    """
+    Shell substitution expanding to the artifacts built for `names`.
+    """
+    return f"$(cat {AUR_BUILD_ROOT}/lists/* | grep -E {_artifact_patterns(names)})"
+
+
+def install_artifacts_command(names: list[str], asdeps: bool = False) -> str:
+    """
+    Installs the artifacts built for `names` in a single pacman transaction.
+    """
+    install_cmd = ["pacman", "-U", "--needed", "--noconfirm", "--noprogressbar"]
+    if asdeps:
+        install_cmd.append("--asdeps")
+    return f"{' '.join(install_cmd)} {select_artifacts(names)}"
+
+
+def publish_artifacts_command(pkgbase: str, files: dict[str, str]) -> str:
+    """
+    Links the artifacts built for `pkgbase` under the predictable file names
+    they are published with.
+    """
+    links = [
+        f'ln -f "$(grep -hE {_artifact_pattern(name)} '
+        f'{AUR_BUILD_ROOT}/lists/{pkgbase} | head -n1)" '
+        f"{AUR_BUILD_ROOT}/publish/{shlex.quote(filename)}"
+        for name, filename in files.items()
+    ]
+    return f"mkdir -p {AUR_BUILD_ROOT}/publish && " + " && ".join(links)
+
+
+def record_artifacts_command(pkgbase: str, filenames: list[str]) -> str:
+    """
+    Records pulled artifacts the same way a local build records its own.
+    """
+    paths = " ".join(
+        shlex.quote(f"{AUR_BUILD_ROOT}/pkgs/{filename}") for filename in filenames
+    )
+    return (
+        f"mkdir -p {AUR_BUILD_ROOT}/lists && "
+        f"printf '%s\\n' {paths} > {AUR_BUILD_ROOT}/lists/{pkgbase}"
+    )
@@ -0,0 +1,127 @@
+from typing import Any
+
+from charonte.roles.pkgs.tasks.aur import strip_version
+
+LOCAL_DB_FIELDS = ("NAME", "SIZE", "REASON", "DEPENDS", "PROVIDES")
+
+
+def parse_local_db(output: list[str]) -> dict[str, dict[str, Any]]:
+    """
+    Builds the dependency graph index from the `desc` entries of the local DB,
+    each one introduced by a `##` line.
+    """
+    records: list[dict[str, list[str]]] = []
+    section = None
+    for line in output:
+        line = line.strip()
+        if line == "##":
+            records.append({})
+            section = None
+        elif line.startswith("%") and line.endswith("%"):
+            section = line.strip("%")
+        elif line and section and records:
+            records[-1].setdefault(section, []).append(line)
+
+    graph = {}
+    for record in records:
+        names = record.get("NAME")
+        if not names:
+            continue
+        try:
+            size = int(record.get("SIZE", ["0"])[0])
+        except ValueError:
+            size = 0
+        graph[names[0]] = {
+            "size": size,
+            "explicit": record.get("REASON", ["0"])[0] != "1",
+            "depends": sorted(
+                {strip_version(dep) for dep in record.get("DEPENDS", [])}
+            ),
+            "provides": sorted(
+                {strip_version(name) for name in record.get("PROVIDES", [])}
+            ),
+        }
+    return graph
+
+
+def _index(
+    graph: dict[str, dict[str, Any]],
+) -> tuple[dict[str, set[str]], dict[str, set[str]]]:
+    providers: dict[str, set[str]] = {}
+    dependants: dict[str, set[str]] = {}
+    for name, entry in graph.items():
+        for provided in [name, *entry["provides"]]:
+            providers.setdefault(provided, set()).add(name)
+        for dep in entry["depends"]:
+            dependants.setdefault(dep, set()).add(name)
+    return providers, dependants
+
+
+def required_packages(
+    graph: dict[str, dict[str, Any]], candidates: list[str]
+) -> set[str]:
+    """
+    Returns the `candidates` that the explicit packages kept outside of them
+    still depend on, directly or through other packages.
+    """
+    providers, _ = _index(graph)
+    excluded = set(candidates)
+
+    reached = {
+        name
+        for name, entry in graph.items()
+        if entry["explicit"] and name not in excluded
+    }
+    pending = list(reached)
+    while pending:
+        for dep in graph[pending.pop()]["depends"]:
+            for provider in providers.get(dep, ()):
+                if provider not in reached:
+                    reached.add(provider)
+                    pending.append(provider)
+    return excluded & reached
+
+
+def removal_closure(
+    graph: dict[str, dict[str, Any]],
+    targets: list[str],
+    cascade: bool = True,
+    recursive: bool = True,
+) -> set[str]:
+    """
+    Predicts every package `pacman -R` removes for `targets`, with `cascade`
+    matching -c and `recursive` matching -s.
+    """
+    providers, dependants = _index(graph)
+
+    def names(package: str) -> list[str]:
+        return [package, *graph[package]["provides"]]
+
+    removed = {target for target in targets if target in graph}
+    pending = list(removed)
+    while pending:
+        package = pending.pop()
+
+        if cascade:
+            for provided in names(package):
+                if not providers[provided] <= removed:
+                    continue
+                for dependant in dependants.get(provided, ()):
+                    if dependant not in removed:
+                        removed.add(dependant)
+                        pending.append(dependant)
+
+        if recursive:
+            for dep in graph[package]["depends"]:
+                for provider in providers.get(dep, ()):
+                    if provider in removed or graph[provider]["explicit"]:
+                        continue
+                    still_needed = any(
+                        dependant not in removed
+                        for provided in names(provider)
+                        for dependant in dependants.get(provided, ())
+                    )
+                    if not still_needed:
+                        removed.add(provider)
+                        pending.append(provider)
+    return removed
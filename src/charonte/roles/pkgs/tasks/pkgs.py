@@ -1,12 +1,334 @@
+import hashlib
 import re
+import shlex
 from typing import Any
 
 from chaos.lib.args.dataclasses import Delta, ResultPayload
 from chaos.lib.roles.role import Role
+from pyinfra.api import FactBase, operation
 from pyinfra.api.operation import add_op
-from pyinfra.facts.files import Directory
-from pyinfra.facts.server import Command
-from pyinfra.operations import server
+from pyinfra.operations import files, server
+
+from charonte.lib import pacman
+from charonte.lib.cache import get_fact_cache
+from charonte.roles.pkgs.tasks.aur import (
+    AUR_BUILD_ROOT,
+    AUR_METADATA_TTL,
+    AurArtifactStore,
+    build_level_command,
+    fetch_aur_info,
+    install_artifacts_command,
+    is_vcs_package,
+    load_aur_snapshot,
+    plan_aur_builds,
+    publish_artifacts_command,
+    record_artifacts_command,
+    resolve_aur_closure,
+    select_artifacts,
+    vercmp,
+)
+from charonte.roles.pkgs.tasks.graph import (
+    parse_local_db,
+    removal_closure,
+    required_packages,
+)
+
+PACMAN_SNAPSHOT_SECTIONS = {
+    "native_packages": "pacman -Qqen",
+    "native_dependencies": "pacman -Qqdn",
+    "aur_packages": "pacman -Qqem",
+    "aur_dependencies": "pacman -Qqdm",
+}
+PACMAN_VERSIONS_SECTION = ("aur_versions", "pacman -Qm")
+
+
+class PacmanSnapshot(FactBase):
+    """
+    Returns the local package sets and the boot mode in a single round trip.
+
+    .. code:: python
+
+        {
+            "native_packages": ["base", ...],
+            "native_dependencies": ["glibc", ...],
+            "aur_packages": ["yay", ...],
+            "aur_dependencies": [...],
+            "aur_versions": {"yay": "12.4.2-1", ...},
+            "boot_mode": "UEFI",
+        }
+    """
+
+    def command(self) -> str:
+        sections = [
+            f"echo '##{section}'; {query} 2>/dev/null"
+            for section, query in [
+                *PACMAN_SNAPSHOT_SECTIONS.items(),
+                PACMAN_VERSIONS_SECTION,
+            ]
+        ]
+        sections.append(
+            "echo '##boot_mode'; if [ -d /sys/firmware/efi/ ]; "
+            "then echo UEFI; else echo BIOS; fi"
+        )
+        return "; ".join(sections)
+
+    @staticmethod
+    def default() -> dict[str, Any]:
+        snapshot: dict[str, Any] = {section: [] for section in PACMAN_SNAPSHOT_SECTIONS}
+        snapshot[PACMAN_VERSIONS_SECTION[0]] = {}
+        snapshot["boot_mode"] = "BIOS"
+        return snapshot
+
+    def process(self, output) -> dict[str, Any]:
+        snapshot = self.default()
+        section = None
+        for line in output:
+            line = line.strip()
+            if line.startswith("##"):
+                section = line[2:]
+                continue
+            if not line or section is None:
+                continue
+            if section == "boot_mode":
+                snapshot["boot_mode"] = line
+            elif section == PACMAN_VERSIONS_SECTION[0] and " " in line:
+                name, version = line.split(" ", 1)
+                snapshot[section][name] = version
+            elif section in snapshot:
+                snapshot[section].append(line)
+        return snapshot
+
+
+class PacmanFingerprint(FactBase):
+    """
+    Returns a cheap digest of the local and sync pacman databases, which changes
+    whenever a package is installed, removed or the sync databases are refreshed.
+    """
+
+    def command(self) -> str:
+        return (
+            "stat -c '%n %Y' /var/lib/pacman/local /var/lib/pacman/sync/*.db "
+            "2>/dev/null; ls -1 /var/lib/pacman/local 2>/dev/null | wc -l"
+        )
+
+    def process(self, output) -> str:
+        return hashlib.sha1("\n".join(output).encode("utf-8")).hexdigest()
+
+
+class PacmanResolve(FactBase):
+    """
+    Resolves names that are not installed literally into the sync group members
+    and the local package satisfying them through provides.
+
+    .. code:: python
+
+        {
+            "xorg": {"provider": None, "members": ["xorg-server", ...]},
+            "sh": {"provider": "bash", "members": []},
+        }
+    """
+
+    def command(self, names: list[str]) -> str:
+        return (
+            f'for n in {" ".join(names)}; do echo "##$n"; '
+            "pacman -Sqg \"$n\" 2>/dev/null | sed 's/^/member /'; "
+            "pacman -Qq \"$n\" 2>/dev/null | sed 's/^/provider /'; done"
+        )
+
+    default = dict
+
+    def process(self, output) -> dict[str, dict[str, Any]]:
+        resolved: dict[str, dict[str, Any]] = {}
+        current = None
+        for line in output:
+            line = line.strip()
+            if line.startswith("##"):
+                current = {"provider": None, "members": []}
+                resolved[line[2:]] = current
+                continue
+            if current is None or " " not in line:
+                continue
+            kind, name = line.split(" ", 1)
+            if kind == "member":
+                current["members"].append(name)
+            elif kind == "provider":
+                current["provider"] = name
+        return resolved
+
+
+class PacmanLocalGraph(FactBase):
+    """
+    Returns the dependency graph index of the local pacman DB, see
+    `parse_local_db`.
+    """
+
+    def command(self) -> str:
+        return (
+            'awk \'FNR == 1 { print "##" } '
+            "/^%/ { keep = ($0 ~ /^%(NAME|SIZE|REASON|DEPENDS|PROVIDES)%$/) } "
+            "keep && NF' /var/lib/pacman/local/*/desc"
+        )
+
+    default = dict
+
+    def process(self, output) -> dict[str, dict[str, Any]]:
+        return parse_local_db(output)
+
+
+class PacmanSizes(FactBase):
+    """
+    Returns the download and installed size in bytes of every sync package
+    `pacman -S` would install for `names`, dependencies included. Sizes
+    pacman could not report are None.
+
+    .. code:: python
+
+        {"vim": {"download": 1843200, "installed": 4939776}}
+    """
+
+    def command(self, names: list[str]) -> str:
+        targets = " ".join(names)
+        print_sizes = "LC_ALL=C pacman -Sp --print-format '%r/%n %s'"
+        return (
+            f"list=$({print_sizes} {targets} 2>/dev/null) || "
+            # One target pacman cannot resolve fails the whole query, so each
+            # is retried alone and the failing ones are reported as unknown.
+            f'list=$(for name in {targets}; do {print_sizes} "$name" '
+            '2>/dev/null || echo "unknown/$name -"; done); '
+            'echo "$list" | sed "s/^[^/]*\\//download /"; '
+            'known=$(echo "$list" | grep -v " -$" | cut -d" " -f1); '
+            '[ -z "$known" ] || LC_ALL=C pacman -Si $known '
+            "| awk -F' *: ' '/^Name/ { n = $2 } "
+            '/^Installed Size/ { print "installed " n " " $2 }\''
+        )
+
+    default = dict
+
+    def process(self, output) -> dict[str, dict[str, int | None]]:
+        sizes: dict[str, dict[str, int | None]] = {}
+        for line in output:
+            parts = line.split()
+            if len(parts) < 3:
+                continue
+            kind, name = parts[0], parts[1]
+            if kind == "download" and parts[2].isdigit():
+                sizes.setdefault(name, {"download": 0, "installed": None})
+                sizes[name]["download"] = int(parts[2])
+            elif kind == "download" and parts[2] == "-":
+                sizes.setdefault(name, {"download": None, "installed": None})
+            elif kind == "installed" and name in sizes:
+                sizes[name]["installed"] = _parse_size(" ".join(parts[2:]))
+        return sizes
+
+
+def _parse_size(value: str) -> int | None:
+    units = {"B": 1, "KiB": 1024, "MiB": 1024**2, "GiB": 1024**3, "TiB": 1024**4}
+    try:
+        number, unit = value.split()
+        return int(float(number) * units[unit])
+    except (KeyError, ValueError):
+        return None
+
+
+def _format_size(size: int) -> str:
+    value = float(size)
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(value) < 1024:
+            return f"{size} B" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} TiB"
+
+
+class MakepkgProfile(FactBase):
+    """
+    Returns the architecture and a digest of the makepkg configuration, which
+    together decide whether an AUR artifact built elsewhere can be reused.
+    """
+
+    def command(self) -> str:
+        return (
+            "uname -m; cat /etc/makepkg.conf /etc/makepkg.conf.d/*.conf "
+            '"$HOME/.makepkg.conf" 2>/dev/null | sha256sum | cut -d" " -f1'
+        )
+
+    def process(self, output) -> dict[str, str]:
+        lines = [line.strip() for line in output if line.strip()]
+        return {
+            "arch": lines[0] if lines else "",
+            "conf_hash": lines[1] if len(lines) > 1 else "",
+        }
+
+
+class AurVcsOutdated(FactBase):
+    """
+    Returns the VCS pkgbases whose kept source clone no longer matches the
+    remote HEAD, looking at the build root and the yay/paru caches.
+    """
+
+    def command(self, pkgbases: list[str]) -> str:
+        return (
+            f"for b in {' '.join(pkgbases)}; do "
+            f'for d in {AUR_BUILD_ROOT}/src/"$b"/*/ "$HOME/.cache/yay/$b"/*/ '
+            '"$HOME/.cache/paru/clone/$b"/*/; do '
+            'if [ -f "${d}HEAD" ]; then '
+            'l=$(git --git-dir="$d" rev-parse HEAD 2>/dev/null); '
+            'r=$(git --git-dir="$d" ls-remote origin HEAD 2>/dev/null | cut -f1); '
+            'if [ -n "$r" ] && [ "$l" != "$r" ]; then echo "$b"; fi; break; '
+            "fi; done; done; true"
+        )
+
+    default = list
+
+    def process(self, output) -> list[str]:
+        return sorted({line.strip() for line in output if line.strip()})
+
+
+@operation(is_idempotent=False)
+def sync_aur_artifacts(store_options: Any, artifacts: dict[str, Any], jobs: int = 0):
+    """
+    Pulls the store's artifacts of each pkgbase, or builds the pkgbase and
+    publishes what it built to the store.
+
+    The store is checked when the op runs rather than when it is planned, so
+    with `_serial` the first host builds a pkgbase and the hosts after it in
+    the same run pull the result.
+    """
+    store = AurArtifactStore.from_options(store_options)
+    to_build = []
+    for pkgbase, artifact in artifacts.items():
+        filenames = list(artifact["files"].values())
+        if not store.has(artifact["key"], filenames):
+            to_build.append(pkgbase)
+            continue
+        for filename in filenames:
+            dest = f"{AUR_BUILD_ROOT}/pkgs/{filename}"
+            url = store.remote_url(artifact["key"], filename)
+            if url:
+                yield (
+                    f"curl -fsSL --create-dirs -o {shlex.quote(dest)} "
+                    f"{shlex.quote(url)}"
+                )
+            else:
+                yield from files.put._inner(
+                    src=store.local_path(artifact["key"], filename),
+                    dest=dest,
+                    create_remote_dir=True,
+                )
+        yield record_artifacts_command(pkgbase, filenames)
+
+    if not to_build:
+        return
+    yield build_level_command(to_build, jobs)
+    for pkgbase in to_build:
+        artifact = artifacts[pkgbase]
+        yield publish_artifacts_command(pkgbase, artifact["files"])
+        for filename in artifact["files"].values():
+            yield from files.get._inner(
+                src=f"{AUR_BUILD_ROOT}/publish/{filename}",
+                dest=store.local_path(artifact["key"], filename),
+                add_deploy_dir=False,
+                create_local_dir=True,
+            )
 
 
 class _PkgsBaseRole(Role):
@@ -26,18 +348,341 @@ class _PkgsBaseRole(Role):
         return valid, invalid
 
     @staticmethod
-    def _check_boot_mode(host) -> str:
-        path = "/sys/firmware/efi/"
-        if host.get_fact(Directory, path=path):
-            return "UEFI"
-        else:
-            return "BIOS"
+    def _installed_packages(context: dict[str, Any]) -> set[str]:
+        return (
+            set(context.get("native_packages", []))
+            | set(context.get("native_dependencies", []))
+            | set(context.get("aur_packages", []))
+            | set(context.get("aur_dependencies", []))
+        )
+
+    def _get_pkgs_context(
+        self,
+        host,
+        context: dict[str, Any],
+        resolve_native: bool = True,
+        resolve_aur: bool = False,
+    ) -> None:
+        cache = get_fact_cache("pkgs", context.get("factCache"))
+        fingerprint = None
+        snapshot = None
+
+        if cache:
+            try:
+                fingerprint = host.get_fact(PacmanFingerprint)
+            except Exception:
+                fingerprint = None
+            if fingerprint:
+                snapshot = cache.get(host.name, fingerprint)
+
+        if snapshot is None:
+            try:
+                snapshot = host.get_fact(PacmanSnapshot)
+            except Exception:
+                snapshot = PacmanSnapshot().default()
+            else:
+                if cache and fingerprint:
+                    cache.set(host.name, fingerprint, snapshot)
+
+        context.update(snapshot)
+
+        if resolve_native:
+            self._get_resolution_context(host, context, fingerprint)
+            self._get_graph_context(host, context, fingerprint)
+            if context.get("estimateSizes"):
+                self._get_sizes_context(host, context)
+        if resolve_aur:
+            self._get_aur_metadata_context(host, context)
+
+    def _get_resolution_context(
+        self, host, context: dict[str, Any], fingerprint: str | None
+    ) -> None:
+        installed = set(context.get("native_packages", [])) | set(
+            context.get("native_dependencies", [])
+        )
+        unresolved, _ = self._validate_input(
+            sorted(set(self._get_declared_native(context)) - installed)
+        )
+        if not unresolved:
+            context["resolved_native"] = {}
+            return
+
+        cache = get_fact_cache("pkgs-resolve", context.get("factCache"))
+        resolved = {}
+        if cache and fingerprint:
+            resolved = cache.get(host.name, fingerprint) or {}
+
+        missing = [name for name in unresolved if name not in resolved]
+        if missing:
+            try:
+                resolved.update(host.get_fact(PacmanResolve, names=missing))
+            except Exception:
+                pass
+            else:
+                if cache and fingerprint:
+                    cache.set(host.name, fingerprint, resolved)
+
+        context["resolved_native"] = {
+            name: resolved[name] for name in unresolved if name in resolved
+        }
+
+    def _get_graph_context(
+        self, host, context: dict[str, Any], fingerprint: str | None
+    ) -> None:
+        context["local_graph"] = {}
+        _, to_remove = self._get_native_delta(context)
+        if not to_remove:
+            return
+
+        cache = get_fact_cache("pkgs-graph", context.get("factCache"))
+        graph = None
+        if cache and fingerprint:
+            graph = cache.get(host.name, fingerprint)
+
+        if graph is None:
+            try:
+                graph = host.get_fact(PacmanLocalGraph)
+            except Exception:
+                graph = {}
+            else:
+                if cache and fingerprint:
+                    cache.set(host.name, fingerprint, graph)
+
+        context["local_graph"] = graph
+
+    def _get_sizes_context(self, host, context: dict[str, Any]) -> None:
+        context["native_sizes"] = {}
+        to_add, _ = self._get_native_delta(context)
+        valid_add, _ = self._validate_input(to_add)
+        if not valid_add:
+            return
+        try:
+            context["native_sizes"] = host.get_fact(PacmanSizes, names=valid_add)
+        except Exception:
+            context["native_sizes"] = {
+                name: {"download": None, "installed": None} for name in valid_add
+            }
+
+    def _get_aur_metadata_context(self, host, context: dict[str, Any]) -> None:
+        context["aur_metadata"] = {}
+        context["aur_artifacts"] = {}
+        context["aur_vcs_outdated"] = []
+        options = context.get("aurBuild")
+        if not options:
+            return
+        settings = {} if isinstance(options, bool) else options
+
+        snapshot = None
+        if settings.get("metadata"):
+            try:
+                snapshot = load_aur_snapshot(settings["metadata"])
+            except (OSError, ValueError, KeyError, TypeError, AttributeError):
+                snapshot = {}
+        cache = get_fact_cache(
+            "aur-metadata", context.get("factCache"), AUR_METADATA_TTL
+        )
+        installed = self._installed_packages(context)
+
+        try:
+            if settings.get("upgrade"):
+                declared, _ = self._validate_input(
+                    sorted(set(context.get("aurPackages", [])) & installed)
+                )
+                context["aur_metadata"] = fetch_aur_info(declared, snapshot, cache)
+                self._get_aur_vcs_context(host, context)
+
+            to_add_aur, _, _ = self._get_aur_delta(context)
+            valid_add, _ = self._validate_input(to_add_aur)
+            context["aur_metadata"].update(
+                resolve_aur_closure(valid_add, installed, snapshot, cache)
+            )
+        except (OSError, ValueError):
+            context["aur_metadata"] = {}
+            context["aur_vcs_outdated"] = []
+
+        if isinstance(options, bool) or not context["aur_metadata"]:
+            return
+        store = AurArtifactStore.from_options(options.get("artifactCache"))
+        if store:
+            self._get_aur_artifacts_context(host, context, store)
+
+    def _get_aur_vcs_context(self, host, context: dict[str, Any]) -> None:
+        metadata = context["aur_metadata"]
+        vcs_names = [name for name in metadata if is_vcs_package(name)]
+        base_of = {
+            name: metadata[name].get("PackageBase") or name for name in vcs_names
+        }
+        pkgbases, _ = self._validate_input(sorted(set(base_of.values())))
+        if not pkgbases:
+            return
+
+        try:
+            outdated = set(host.get_fact(AurVcsOutdated, pkgbases=pkgbases))
+        except Exception:
+            outdated = set()
+        context["aur_vcs_outdated"] = sorted(
+            name for name, base in base_of.items() if base in outdated
+        )
+
+    def _get_aur_artifacts_context(
+        self, host, context: dict[str, Any], store: AurArtifactStore
+    ) -> None:
+        try:
+            profile = host.get_fact(MakepkgProfile)
+        except Exception:
+            return
+        if not profile or not profile.get("arch") or not profile.get("conf_hash"):
+            return
+
+        packages: dict[str, list[str]] = {}
+        for name, entry in context["aur_metadata"].items():
+            packages.setdefault(entry.get("PackageBase") or name, []).append(name)
+
+        for pkgbase, names in packages.items():
+            version = context["aur_metadata"][names[0]].get("Version")
+            if not version:
+                continue
+            key = store.key(pkgbase, version, profile["arch"], profile["conf_hash"])
+            artifact_files = {
+                name: store.filename(name, version, profile["arch"])
+                for name in sorted(names)
+            }
+            cached = store.has(key, list(artifact_files.values()))
+            context["aur_artifacts"][pkgbase] = {
+                "key": key,
+                "files": artifact_files,
+                "cached": cached,
+            }
+            if cached:
+                context["aur_artifacts"][pkgbase]["bytes"] = store.size(
+                    key, list(artifact_files.values())
+                )
 
     def _get_native_delta(self, context: dict[str, Any]) -> tuple[list[str], list[str]]:
-        ChObolo = context
-        aur_helper_list = ChObolo.get("aurHelpers", [])
         native = context.get("native_packages", [])
         dependencies = context.get("native_dependencies", [])
+        resolved_native = context.get("resolved_native", {})
+
+        declared = set(self._get_declared_native(context))
+        installed = set(native) | set(dependencies)
+
+        # Groups and virtual (provides) names never show up in the installed set,
+        # so they are matched against what they resolve to on the host instead.
+        satisfied = set()
+        expanded = set()
+        for name in declared - installed:
+            resolution = resolved_native.get(name) or {}
+            provider = resolution.get("provider")
+            members = set(resolution.get("members") or [])
+
+            if provider and provider in installed:
+                satisfied.add(name)
+                expanded.add(provider)
+            elif members:
+                expanded.update(members)
+                if members <= installed:
+                    satisfied.add(name)
+
+        toAddNative = sorted(declared - installed - satisfied)
+        toRemoveNative = sorted(set(native) - declared - expanded)
+        return toAddNative, toRemoveNative
+
+    @staticmethod
+    def _get_reason_delta(
+        context: dict[str, Any], to_remove_native: list[str]
+    ) -> tuple[list[str], list[str]]:
+        """
+        Returns the declared packages installed as dependencies, and the
+        undeclared explicit packages something kept still depends on.
+        """
+        declared = set(_PkgsBaseRole._get_declared_native(context))
+        as_explicit = sorted(declared & set(context.get("native_dependencies", [])))
+
+        graph = context.get("local_graph")
+        as_deps = sorted(required_packages(graph, to_remove_native)) if graph else []
+        return as_explicit, as_deps
+
+    @staticmethod
+    def _get_removal_impact(
+        context: dict[str, Any], to_remove_native: list[str]
+    ) -> dict[str, Any] | None:
+        graph = context.get("local_graph")
+        if not graph or not to_remove_native:
+            return None
+
+        # Mirrors the -Rcns the native removal runs with.
+        closure = removal_closure(graph, to_remove_native)
+        return {
+            "packages": sorted(closure),
+            "cascaded": sorted(closure - set(to_remove_native)),
+            "freed_bytes": sum(graph[name]["size"] for name in closure),
+        }
+
+    @staticmethod
+    def _get_size_estimate(
+        context: dict[str, Any],
+        aur_build: dict[str, Any] | None = None,
+        removal_impact: dict[str, Any] | None = None,
+    ) -> dict[str, Any] | None:
+        if not context.get("estimateSizes"):
+            return None
+
+        # Packages pacman could not size are reported rather than counted as
+        # empty, so the totals never look smaller than they are.
+        packages: dict[str, dict[str, int | None]] = {}
+        unknown = []
+        for name, size in context.get("native_sizes", {}).items():
+            if size.get("download") is None or size.get("installed") is None:
+                unknown.append(name)
+            else:
+                packages[name] = dict(size)
+        # Only AUR artifacts already in the store have a known size; their
+        # installed size is not recorded anywhere.
+        unestimated = []
+        artifacts = (aur_build or {}).get("artifacts", {})
+        for pkgbase in (aur_build or {}).get("packages", {}):
+            artifact = artifacts.get(pkgbase, {})
+            if artifact.get("cached") and "bytes" in artifact:
+                packages[pkgbase] = {"download": artifact["bytes"], "installed": None}
+            else:
+                unestimated.append(pkgbase)
+
+        installed = sum(size["installed"] or 0 for size in packages.values())
+        freed = (removal_impact or {}).get("freed_bytes", 0)
+        return {
+            "download_bytes": sum(size["download"] or 0 for size in packages.values()),
+            "installed_change_bytes": installed - freed,
+            "packages": packages,
+            "unestimated": sorted(unestimated),
+            "unknown": sorted(unknown),
+        }
+
+    @staticmethod
+    def _get_size_messages(delta: Delta) -> list[str]:
+        estimate = delta.metadata.get("size_estimate")
+        if not estimate:
+            return []
+        messages = [
+            f"Download: {_format_size(estimate['download_bytes'])}, "
+            f"installed size change: "
+            f"{_format_size(estimate['installed_change_bytes'])}"
+        ]
+        if estimate["unestimated"]:
+            messages.append(
+                "AUR packages built on the host, not estimated: "
+                + ", ".join(estimate["unestimated"])
+            )
+        if estimate["unknown"]:
+            messages.append(
+                "Packages pacman could not size, left out of the totals: "
+                + ", ".join(estimate["unknown"])
+            )
+        return messages
+
+    @staticmethod
+    def _get_declared_native(context: dict[str, Any]) -> list[str]:
+        ChObolo = context
+        aur_helper_list = ChObolo.get("aurHelpers", [])
 
         pkgs = ChObolo.get("packages", [])
         necOver = ChObolo.get("baseOverride", [])
@@ -94,9 +739,7 @@ class _PkgsBaseRole(Role):
         else:
             basePkgs.append("grub")
 
-        toAddNative = sorted(set(basePkgs) - set(native) - set(dependencies))
-        toRemoveNative = sorted(set(native) - set(basePkgs))
-        return toAddNative, toRemoveNative
+        return basePkgs
 
     def _get_aur_delta(
         self, context: dict[str, Any]
@@ -116,47 +759,103 @@ class _PkgsBaseRole(Role):
         aurPkgs = ChObolo.get("aurPackages", [])
         if aurPkgs:
             toRemoveAur = sorted(set(aur) - set(aurPkgs))
-            toAddAur = sorted(set(aurPkgs) - set(aur) - set(aurDependencies))
+            toAddAur = sorted(
+                (set(aurPkgs) - set(aur) - set(aurDependencies))
+                | self._get_outdated_aur(context, aurPkgs)
+            )
             return toAddAur, toRemoveAur, aur_helper
         return [], [], aur_helper
 
-    def _plan_native(self, state, delta: Delta) -> list[str]:
+    @staticmethod
+    def _get_outdated_aur(context: dict[str, Any], declared: list[str]) -> set[str]:
+        options = context.get("aurBuild")
+        if not options or isinstance(options, bool) or not options.get("upgrade"):
+            return set()
+
+        metadata = context.get("aur_metadata") or {}
+        installed_versions = context.get("aur_versions") or {}
+        vcs_outdated = set(context.get("aur_vcs_outdated") or [])
+
+        outdated = set()
+        for name in declared:
+            installed_version = installed_versions.get(name)
+            if not installed_version:
+                continue
+            if is_vcs_package(name):
+                if name in vcs_outdated:
+                    outdated.add(name)
+                continue
+            aur_version = (metadata.get(name) or {}).get("Version")
+            if aur_version and vercmp(aur_version, installed_version) > 0:
+                outdated.add(name)
+        return outdated
+
+    def _get_aur_build(
+        self, context: dict[str, Any], to_add_aur: list[str]
+    ) -> dict[str, Any] | None:
+        options = context.get("aurBuild")
+        metadata = context.get("aur_metadata")
+        if not options or not to_add_aur or not metadata:
+            return None
+
+        artifacts = context.get("aur_artifacts", {})
+        prebuilt = {base for base, artifact in artifacts.items() if artifact["cached"]}
+        build = plan_aur_builds(
+            to_add_aur, metadata, self._installed_packages(context), prebuilt
+        )
+        if not build:
+            return None
+
+        names = list(build["packages"]) + [
+            name for names in build["packages"].values() for name in names
+        ]
+        _, invalid = self._validate_input(names + build["repo_deps"])
+        if invalid:
+            return None
+
+        jobs = options.get("jobs", 0) if not isinstance(options, bool) else 0
+        try:
+            build["jobs"] = max(int(jobs), 0)
+        except (TypeError, ValueError):
+            build["jobs"] = 0
+
+        if not isinstance(options, bool) and artifacts:
+            build["store"] = options.get("artifactCache")
+            build["artifacts"] = {
+                pkgbase: artifacts[pkgbase]
+                for pkgbase in build["packages"]
+                if pkgbase in artifacts
+            }
+        return build
+
+    def _plan_native(self, state, host, delta: Delta) -> list[str]:
         to_add_native = delta.to_add.get("native", [])
         to_remove_native = delta.to_remove.get("native", [])
+        to_mark_explicit = delta.to_add.get("native_asexplicit", [])
+        to_mark_deps = delta.to_add.get("native_asdeps", [])
 
-        if not to_add_native and not to_remove_native:
+        if not any([to_add_native, to_remove_native, to_mark_explicit, to_mark_deps]):
             return []
 
-        if to_add_native:
-            add_cmd = [
-                "pacman",
-                "-S",
-                "--needed",
-                "--noconfirm",
-                "--noprogressbar",
-                "--asexplicit",
-            ]
-            add_cmd.extend(to_add_native)
-            add_op(
-                state,
-                server.shell,
-                name="Installing native packages",
-                commands=" ".join(add_cmd),
-                _sudo=True,
-            )
-        if to_remove_native:
-            remove_cmd = ["pacman", "-Rcns", "--noconfirm", "--noprogressbar"]
-            remove_cmd.extend(to_remove_native)
-            add_op(
-                state,
-                server.shell,
-                name="Uninstalling native packages",
-                commands=" ".join(remove_cmd),
-                _sudo=True,
-            )
+        if to_mark_explicit or to_mark_deps:
+            # pacman -D rewrites the reason in place without changing the DB
+            # fingerprint, so the cached facts would go stale. The options are
+            # the ones the facts were read with, so the same cache is cleared.
+            for namespace in ("pkgs", "pkgs-graph"):
+                cache = get_fact_cache(namespace, delta.metadata.get("fact_cache"))
+                if cache:
+                    cache.invalidate(host.name)
+
+        if delta.metadata.get("prefetch"):
+            pacman.start_prefetch(state, host, to_add_native)
+        pacman.queue_install(state, host, to_add_native)
+        pacman.queue_mark(state, host, to_mark_explicit, explicit=True)
+        pacman.queue_mark(state, host, to_mark_deps, explicit=False)
+        pacman.queue_remove(state, host, to_remove_native, flags="-Rcns")
+        pacman.flush_transaction(state, host, name="Syncing native packages")
         return []
 
-    def _plan_aur(self, state, delta: Delta) -> list[str]:
+    def _plan_aur(self, state, host, delta: Delta) -> list[str]:
         to_add_aur = delta.to_add.get("aur", [])
         to_remove_aur = delta.to_remove.get("aur", [])
         aur_helper = delta.metadata.get("aur_helper")
@@ -165,10 +864,18 @@ class _PkgsBaseRole(Role):
         if not aur_work_to_do:
             return []
 
-        if not aur_helper:
+        aur_build = delta.metadata.get("aur_build")
+        if not aur_helper and not aur_build:
             return ["AUR_HELPER_MISSING"]
 
-        if to_add_aur:
+        if to_add_aur and aur_build:
+            self._plan_aur_build(state, host, aur_build)
+        elif to_add_aur:
+            # The helper runs its own transactions, so whatever is pending,
+            # freshly built helpers included, has to be installed first.
+            pacman.flush_transaction(
+                state, host, name="Syncing pending packages", barrier=True
+            )
             add_command = [
                 aur_helper,
                 "-S",
@@ -179,24 +886,120 @@ class _PkgsBaseRole(Role):
                 "All",
                 "--removemake",
             ]
-            add_command.extend(to_add_aur)
             add_op(
                 state,
                 server.shell,
-                commands=" ".join(add_command),
+                commands=[
+                    pacman.PREFETCH_WAIT,
+                    *pacman.chunked_commands(add_command, to_add_aur),
+                ],
                 name="Installing AUR packages.",
             )
-        if to_remove_aur:
+        if to_remove_aur and aur_helper:
             remove_command = [aur_helper, "-Rns", "--noconfirm"]
-            remove_command.extend(to_remove_aur)
             add_op(
                 state,
                 server.shell,
-                commands=" ".join(remove_command),
+                commands=[
+                    pacman.PREFETCH_WAIT,
+                    *pacman.chunked_commands(
+                        remove_command, to_remove_aur, max_targets=None
+                    ),
+                ],
                 name="Uninstalling AUR packages.",
             )
+        elif to_remove_aur:
+            pacman.queue_remove(state, host, to_remove_aur)
+            pacman.flush_transaction(state, host, name="Syncing AUR packages")
         return []
 
+    def _plan_aur_build(self, state, host, aur_build: dict[str, Any]) -> None:
+        repo_deps = aur_build.get("repo_deps", [])
+        make_deps = aur_build.get("make_deps", [])
+        levels = aur_build.get("levels", [])
+        install_after = aur_build.get("install_after", [])
+        jobs = aur_build.get("jobs", 0)
+
+        # Build dependencies join whatever earlier roles queued, and have to be
+        # there before the first build.
+        pacman.queue_install_deps(state, host, repo_deps)
+        pacman.flush_transaction(
+            state, host, name="Installing AUR build dependencies", barrier=True
+        )
+
+        store = AurArtifactStore.from_options(aur_build.get("store"))
+        artifacts = aur_build.get("artifacts", {})
+        targets = set(aur_build.get("targets", []))
+        installed: set[str] = set()
+        for index, level in enumerate(levels, start=1):
+            stored = [b for b in level if store and b in artifacts]
+            prebuilt = [b for b in stored if artifacts[b].get("cached")]
+            missing = [b for b in stored if b not in prebuilt]
+            to_build = [b for b in level if b not in stored]
+
+            if prebuilt:
+                add_op(
+                    state,
+                    sync_aur_artifacts,
+                    name=f"Pulling prebuilt AUR packages ({index}/{len(levels)})",
+                    store_options=aur_build.get("store"),
+                    artifacts={b: artifacts[b] for b in prebuilt},
+                )
+            if missing:
+                # One host at a time, so only the first host builds a pkgbase
+                # missing from the store and the others pull its artifacts.
+                add_op(
+                    state,
+                    sync_aur_artifacts,
+                    name=f"Building or pulling AUR packages ({index}/{len(levels)})",
+                    store_options=aur_build.get("store"),
+                    artifacts={b: artifacts[b] for b in missing},
+                    jobs=jobs,
+                    _serial=True,
+                )
+            if to_build:
+                add_op(
+                    state,
+                    server.shell,
+                    name=f"Building AUR packages ({index}/{len(levels)})",
+                    commands=build_level_command(to_build, jobs),
+                )
+
+            # Later levels build against these, so they cannot wait for the
+            # final transaction.
+            needed = install_after[index - 1] if index <= len(install_after) else []
+            needed_deps = [name for name in needed if name not in targets]
+            needed_targets = [name for name in needed if name in targets]
+            if needed_deps:
+                add_op(
+                    state,
+                    server.shell,
+                    name="Installing built AUR dependencies",
+                    commands=[
+                        pacman.PREFETCH_WAIT,
+                        install_artifacts_command(needed_deps, asdeps=True),
+                    ],
+                    _sudo=True,
+                )
+            if needed_targets:
+                add_op(
+                    state,
+                    server.shell,
+                    name="Installing built AUR packages needed by later builds",
+                    commands=[
+                        pacman.PREFETCH_WAIT,
+                        install_artifacts_command(needed_targets),
+                    ],
+                    _sudo=True,
+                )
+            installed.update(needed)
+
+        remaining = sorted(targets - installed)
+        if remaining:
+            pacman.queue_upgrade(state, host, [select_artifacts(remaining)])
+        pacman.queue_remove_orphans(state, host, make_deps)
+        pacman.flush_transaction(state, host, name="Syncing AUR packages")
+
 
 class PkgsNativeRole(_PkgsBaseRole):
     """
@@ -214,6 +1017,9 @@ class PkgsNativeRole(_PkgsBaseRole):
                 "partitioning",
                 "bootloader",
                 "aurHelpers",
+                "factCache",
+                "prefetch",
+                "estimateSizes",
             ],
         )
 
@@ -221,19 +1027,7 @@ class PkgsNativeRole(_PkgsBaseRole):
         self, state, host, chobolo: dict = {}, secrets: dict[str, Any] = {}
     ) -> dict[str, Any]:
         context = chobolo.copy()
-        try:
-            context["native_packages"] = (
-                host.get_fact(Command, "pacman -Qqen || true").strip().splitlines()
-            )
-        except Exception:
-            context["native_packages"] = []
-        try:
-            context["native_dependencies"] = (
-                host.get_fact(Command, "pacman -Qqdn || true").strip().splitlines()
-            )
-        except Exception:
-            context["native_dependencies"] = []
-        context["boot_mode"] = self._check_boot_mode(host)
+        self._get_pkgs_context(host, context)
         return context
 
     def delta(self, context: dict[str, Any] | None = None) -> Delta:
@@ -241,6 +1035,8 @@ class PkgsNativeRole(_PkgsBaseRole):
         to_add_native, to_remove_native = self._get_native_delta(safe_context)
         valid_add, invalid_add = self._validate_input(to_add_native)
         valid_remove, invalid_remove = self._validate_input(to_remove_native)
+        as_explicit, as_deps = self._get_reason_delta(safe_context, valid_remove)
+        valid_remove = [pkg for pkg in valid_remove if pkg not in as_deps]
 
         to_add = {}
         to_remove = {}
@@ -248,13 +1044,28 @@ class PkgsNativeRole(_PkgsBaseRole):
         if valid_add:
             to_add["native"] = valid_add
 
+        if as_explicit:
+            to_add["native_asexplicit"] = as_explicit
+
+        if as_deps:
+            to_add["native_asdeps"] = as_deps
+
         if valid_remove:
             to_remove["native"] = valid_remove
 
+        removal_impact = self._get_removal_impact(safe_context, valid_remove)
         return Delta(
             to_add=to_add,
             to_remove=to_remove,
-            metadata={"invalid_packages": invalid_add + invalid_remove},
+            metadata={
+                "prefetch": bool(safe_context.get("prefetch")),
+                "fact_cache": safe_context.get("factCache"),
+                "removal_impact": removal_impact,
+                "size_estimate": self._get_size_estimate(
+                    safe_context, removal_impact=removal_impact
+                ),
+                "invalid_packages": invalid_add + invalid_remove,
+            },
         )
 
     def plan(self, state, host, delta: Delta = Delta()) -> ResultPayload:
@@ -262,8 +1073,13 @@ class PkgsNativeRole(_PkgsBaseRole):
             f"INVALID_PACKAGE_NAME:{pkg}"
             for pkg in delta.metadata.get("invalid_packages", [])
         ]
-        errors.extend(self._plan_native(state, delta))
-        return ResultPayload(success=not errors, message=[], error=errors, data=delta)
+        errors.extend(self._plan_native(state, host, delta))
+        return ResultPayload(
+            success=not errors,
+            message=self._get_size_messages(delta),
+            error=errors,
+            data=delta,
+        )
 
 
 class PkgsAurRole(_PkgsBaseRole):
@@ -275,31 +1091,19 @@ class PkgsAurRole(_PkgsBaseRole):
         super().__init__(
             name="Install AUR Packages",
             needs_secrets=False,
-            necessary_chobolo_keys=["aurPackages", "aurHelpers"],
+            necessary_chobolo_keys=[
+                "aurPackages",
+                "aurHelpers",
+                "aurBuild",
+                "factCache",
+            ],
         )
 
     def get_context(
         self, state, host, chobolo: dict = {}, secrets: dict[str, Any] = {}
     ) -> dict[str, Any]:
         context = chobolo.copy()
-        try:
-            context["native_packages"] = (
-                host.get_fact(Command, "pacman -Qqen || true").strip().splitlines()
-            )
-        except Exception:
-            context["native_packages"] = []
-        try:
-            context["aur_packages"] = (
-                host.get_fact(Command, "pacman -Qqem || true").strip().splitlines()
-            )
-        except Exception:
-            context["aur_packages"] = []
-        try:
-            context["aur_dependencies"] = (
-                host.get_fact(Command, "pacman -Qqdm || true").strip().splitlines()
-            )
-        except Exception:
-            context["aur_dependencies"] = []
+        self._get_pkgs_context(host, context, resolve_native=False, resolve_aur=True)
         return context
 
     def delta(self, context: dict[str, Any] = {}) -> Delta:
@@ -320,6 +1124,10 @@ class PkgsAurRole(_PkgsBaseRole):
             to_remove=to_remove,
             metadata={
                 "aur_helper": aur_helper,
+                "aur_build": self._get_aur_build(context, valid_add),
+                "aur_outdated": sorted(
+                    self._get_outdated_aur(context, context.get("aurPackages", []))
+                ),
                 "invalid_packages": invalid_add + invalid_remove,
             },
         )
@@ -329,7 +1137,7 @@ class PkgsAurRole(_PkgsBaseRole):
             f"INVALID_PACKAGE_NAME:{pkg}"
             for pkg in delta.metadata.get("invalid_packages", [])
         ]
-        errors.extend(self._plan_aur(state, delta))
+        errors.extend(self._plan_aur(state, host, delta))
         return ResultPayload(success=not errors, message=[], error=errors, data=delta)
 
 
@@ -350,6 +1158,10 @@ class PkgsAllRole(_PkgsBaseRole):
                 "bootloader",
                 "aurPackages",
                 "aurHelpers",
+                "aurBuild",
+                "factCache",
+                "prefetch",
+                "estimateSizes",
             ],
         )
 
@@ -357,31 +1169,7 @@ class PkgsAllRole(_PkgsBaseRole):
         self, state, host, chobolo: dict = {}, secrets: dict[str, Any] = {}
     ) -> dict[str, Any]:
         context = chobolo.copy()
-        try:
-            context["native_packages"] = (
-                host.get_fact(Command, "pacman -Qqen || true").strip().splitlines()
-            )
-        except Exception:
-            context["native_packages"] = []
-        try:
-            context["native_dependencies"] = (
-                host.get_fact(Command, "pacman -Qqdn || true").strip().splitlines()
-            )
-        except Exception:
-            context["native_dependencies"] = []
-        try:
-            context["aur_packages"] = (
-                host.get_fact(Command, "pacman -Qqem || true").strip().splitlines()
-            )
-        except Exception:
-            context["aur_packages"] = []
-        try:
-            context["aur_dependencies"] = (
-                host.get_fact(Command, "pacman -Qqdm || true").strip().splitlines()
-            )
-        except Exception:
-            context["aur_dependencies"] = []
-        context["boot_mode"] = self._check_boot_mode(host)
+        self._get_pkgs_context(host, context, resolve_aur=True)
         return context
 
     def delta(self, context: dict[str, Any] | None = None) -> Delta:
@@ -394,6 +1182,8 @@ class PkgsAllRole(_PkgsBaseRole):
         valid_remove_nat, invalid_remove_nat = self._validate_input(to_remove_native)
         valid_add_aur, invalid_add_aur = self._validate_input(to_add_aur)
         valid_remove_aur, invalid_remove_aur = self._validate_input(to_remove_aur)
+        as_explicit, as_deps = self._get_reason_delta(safe_context, valid_remove_nat)
+        valid_remove_nat = [pkg for pkg in valid_remove_nat if pkg not in as_deps]
 
         invalid_pkgs = (
             invalid_add_nat + invalid_remove_nat + invalid_add_aur + invalid_remove_aur
@@ -405,6 +1195,12 @@ class PkgsAllRole(_PkgsBaseRole):
         if valid_add_nat:
             to_add["native"] = valid_add_nat
 
+        if as_explicit:
+            to_add["native_asexplicit"] = as_explicit
+
+        if as_deps:
+            to_add["native_asdeps"] = as_deps
+
         if valid_add_aur:
             to_add["aur"] = valid_add_aur
 
@@ -414,10 +1210,27 @@ class PkgsAllRole(_PkgsBaseRole):
         if valid_remove_aur:
             to_remove["aur"] = valid_remove_aur
 
+        aur_build = self._get_aur_build(safe_context, valid_add_aur)
+        removal_impact = self._get_removal_impact(safe_context, valid_remove_nat)
         return Delta(
             to_add=to_add,
             to_remove=to_remove,
-            metadata={"aur_helper": aur_helper, "invalid_packages": invalid_pkgs},
+            metadata={
+                "aur_helper": aur_helper,
+                "aur_build": aur_build,
+                "aur_outdated": sorted(
+                    self._get_outdated_aur(
+                        safe_context, safe_context.get("aurPackages", [])
+                    )
+                ),
+                "prefetch": bool(safe_context.get("prefetch")),
+                "fact_cache": safe_context.get("factCache"),
+                "removal_impact": removal_impact,
+                "size_estimate": self._get_size_estimate(
+                    safe_context, aur_build, removal_impact
+                ),
+                "invalid_packages": invalid_pkgs,
+            },
         )
 
     def plan(self, state, host, delta: Delta = Delta()) -> ResultPayload:
@@ -425,6 +1238,11 @@ class PkgsAllRole(_PkgsBaseRole):
             f"INVALID_PACKAGE_NAME:{pkg}"
             for pkg in delta.metadata.get("invalid_packages", [])
         ]
-        errors.extend(self._plan_native(state, delta))
-        errors.extend(self._plan_aur(state, delta))
-        return ResultPayload(success=not errors, message=[], error=errors, data=delta)
+        errors.extend(self._plan_native(state, host, delta))
+        errors.extend(self._plan_aur(state, host, delta))
+        return ResultPayload(
+            success=not errors,
+            message=self._get_size_messages(delta),
+            error=errors,
+            data=delta,
+        )
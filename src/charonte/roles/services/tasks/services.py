@@ -1,11 +1,29 @@
+import fnmatch
+import hashlib
+import re
+import shlex
+from bisect import bisect_left
 from typing import Any
 
 from chaos.lib.args.dataclasses import Delta, ResultPayload
 from chaos.lib.roles.role import Role
+from pyinfra.api import FactBase
 from pyinfra.api.operation import add_op
-from pyinfra.facts.server import Command
-from pyinfra.operations import systemd
+from pyinfra.operations import server, systemd
 
+from charonte.lib.cache import get_fact_cache
+
+# Activation files of the system bus; a bus name is only started on demand
+# when one of these declares it.
+DBUS_SERVICES_DIR = "/usr/share/dbus-1/system-services"
+# Matches systemd's DefaultTimeoutStartSec.
+SERVICES_WAIT_TIMEOUT = 90
+
+ACTIVE_STATES = {"active", "activating", "reloading"}
+# Unit file states `systemctl enable` cannot change.
+FIXED_UNIT_STATES = {"static", "generated", "transient"}
+
+# Entries may be fnmatch globs, e.g. "systemd-*.service".
 SERVICES_BLACKLIST = {
     "dbus-broker.service",
     "dbus.service",
@@ -52,61 +70,338 @@ SERVICES_BLACKLIST = {
 }
 
 
+_BLACKLIST_PATTERN = re.compile(
+    "|".join(fnmatch.translate(entry) for entry in sorted(SERVICES_BLACKLIST))
+)
+
+
+def is_blacklisted(service: str) -> bool:
+    return _BLACKLIST_PATTERN.match(service) is not None
+
+
+def is_managed(service: str) -> bool:
+    """
+    Template units and initrd services are never managed by the role.
+    """
+    return "@." not in service and "initrd" not in service
+
+
+class ServiceIndex:
+    """
+    The managed service units of a host, sorted once so that every dense
+    service expands with a binary search instead of a scan of all units.
+    """
+
+    def __init__(self, services):
+        self.services = sorted(s for s in set(services) if is_managed(s))
+
+    def with_prefix(self, prefix: str) -> list[str]:
+        start = bisect_left(self.services, prefix)
+        end = start
+        while end < len(self.services) and self.services[end].startswith(prefix):
+            end += 1
+        return self.services[start:end]
+
+
+class ServicesSnapshot(FactBase):
+    """
+    Returns the unit file state, active state and sub-state of every service
+    unit, plus the type and on-demand activation of the loaded ones, from one
+    `list-unit-files`, one `list-units` and one `show` call and the names of
+    the system bus activation files.
+    """
+
+    def command(self) -> str:
+        return (
+            "echo '##files'; "
+            "systemctl list-unit-files --type=service --no-pager --no-legend "
+            "--plain; "
+            "units=$(systemctl list-units --type=service --all --no-pager "
+            "--no-legend --plain); "
+            "echo '##units'; "
+            'echo "$units"; '
+            "echo '##props'; "
+            "echo \"$units\" | awk '{ print $1 }' | xargs -r systemctl show "
+            "-p Id -p Type -p TriggeredBy -p BusName --; "
+            "echo '##dbus'; "
+            f"grep -hs '^Name=' {DBUS_SERVICES_DIR}/*.service; true"
+        )
+
+    default = dict
+
+    def process(self, output) -> dict[str, dict[str, Any]]:
+        services: dict[str, dict[str, Any]] = {}
+
+        def entry(name: str) -> dict[str, Any]:
+            return services.setdefault(
+                name,
+                {
+                    "state": None,
+                    "active": None,
+                    "sub": None,
+                    "type": None,
+                    "on_demand": False,
+                },
+            )
+
+        bus_names: dict[str, str] = {}
+        activatable: set[str] = set()
+        section = None
+        current = current_id = None
+        for line in output:
+            if line.startswith("##"):
+                section = line[2:].strip()
+                continue
+            if section == "props":
+                key, _, value = line.strip().partition("=")
+                if key == "Id":
+                    current_id = value
+                    current = entry(value) if value.endswith(".service") else None
+                elif current is None:
+                    continue
+                elif key == "Type":
+                    current["type"] = value or None
+                elif key == "TriggeredBy" and value:
+                    # Started by a socket, timer or path when needed.
+                    current["on_demand"] = True
+                elif key == "BusName" and value:
+                    bus_names[current_id] = value
+                continue
+            if section == "dbus":
+                key, _, value = line.strip().partition("=")
+                if key == "Name" and value:
+                    activatable.add(value)
+                continue
+
+            fields = line.split()
+            if not fields or not fields[0].endswith(".service"):
+                continue
+            if section == "files" and len(fields) >= 2:
+                entry(fields[0])["state"] = fields[1]
+            elif section == "units" and len(fields) >= 4:
+                entry(fields[0])["active"] = fields[2]
+                entry(fields[0])["sub"] = fields[3]
+
+        # Type=dbus daemons all own a bus name; only those the bus can
+        # activate are idle rather than stopped when inactive.
+        for name, bus_name in bus_names.items():
+            if bus_name in activatable:
+                services[name]["on_demand"] = True
+        return services
+
+
+def is_running_diverged(info: dict[str, Any], running: bool) -> bool:
+    """
+    Whether the runtime state of a service contradicts `running`.
+
+    Failed units always diverge. Inactive ones do not when they are oneshots
+    or are activated on demand, as those are idle rather than stopped.
+    """
+    active = info.get("active")
+    if not running:
+        return active in ACTIVE_STATES
+    if active in ACTIVE_STATES:
+        return False
+    if active == "failed":
+        return True
+    return not (info.get("on_demand") or info.get("type") == "oneshot")
+
+
+def build_systemctl_command(
+    enable: list[str],
+    disable: list[str],
+    start: list[str],
+    stop: list[str],
+    timeout: int = SERVICES_WAIT_TIMEOUT,
+) -> str:
+    """
+    Builds one command applying every service change of a host: one systemctl
+    call per action, with the start and stop jobs queued with --no-block and
+    then awaited together.
+
+    Started units only fail the command when they end up failed, so oneshot
+    services that already exited are fine.
+    """
+
+    def units(names: list[str]) -> str:
+        return " ".join(shlex.quote(name) for name in names)
+
+    lines = ["set -e"]
+    if enable:
+        lines.append(f"systemctl enable {units(enable)}")
+    if disable:
+        lines.append(f"systemctl disable {units(disable)}")
+    if start:
+        lines.append(f"systemctl start --no-block {units(start)}")
+    if stop:
+        lines.append(f"systemctl stop --no-block {units(stop)}")
+    if start or stop:
+        lines.extend(
+            [
+                "waited=0",
+                f"while systemctl is-active {units(start + stop)} | "
+                "grep -qx -e activating -e deactivating -e reloading; do",
+                f'  [ "$waited" -ge {timeout} ] && break',
+                "  sleep 1",
+                "  waited=$((waited + 1))",
+                "done",
+                "rc=0",
+            ]
+        )
+        if start:
+            lines.extend(
+                [
+                    f"for unit in {units(start)}; do",
+                    '  if [ "$(systemctl is-active "$unit")" = failed ]; then',
+                    '    echo "$unit failed to start" >&2; rc=1',
+                    "  fi",
+                    "done",
+                ]
+            )
+        if stop:
+            lines.extend(
+                [
+                    f"for unit in {units(stop)}; do",
+                    '  if [ "$(systemctl is-active "$unit")" = active ]; then',
+                    '    echo "$unit is still active" >&2; rc=1',
+                    "  fi",
+                    "done",
+                ]
+            )
+        lines.append("exit $rc")
+    return "\n".join(lines)
+
+
+class ServiceIds(FactBase):
+    """
+    Returns the canonical unit Id of each of `names` and of the other names
+    they are loaded under, from one `systemctl show` call.
+    """
+
+    def command(self, names: list[str]) -> str:
+        units = " ".join(shlex.quote(name) for name in names)
+        return f"systemctl show -p Id -p Names -- {units}"
+
+    default = dict
+
+    def process(self, output) -> dict[str, str]:
+        ids: dict[str, str] = {}
+        unit_id = None
+        for line in output:
+            key, _, value = line.strip().partition("=")
+            if key == "Id":
+                unit_id = value
+                ids.setdefault(value, value)
+            elif key == "Names" and unit_id:
+                for name in value.split():
+                    ids[name] = unit_id
+        return ids
+
+
+def unit_files_fingerprint(snapshot: dict[str, dict[str, str | None]]) -> str:
+    """
+    Fingerprints the unit files and their states, which is what aliases
+    depend on.
+    """
+    digest = hashlib.sha256()
+    for name in sorted(snapshot):
+        digest.update(f"{name} {snapshot[name].get('state')}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def unit_name(service_name: str) -> str:
+    if service_name.endswith(".service"):
+        return service_name
+    return f"{service_name}.service"
+
+
 class ServicesRole(Role):
     def __init__(self):
         super().__init__(
             name="Set Declared Services to be Enabled and Running",
             needs_secrets=False,
-            necessary_chobolo_keys=["services"],
+            necessary_chobolo_keys=["services", "batchServices", "factCache"],
         )
 
     def get_context(
         self, state, host, chobolo: dict = {}, secrets: dict[str, Any] = {}
     ) -> dict[str, Any]:
         try:
-            services_raw_str = host.get_fact(
-                Command,
-                "systemctl list-unit-files --type=service --no-pager --no-legend | awk '{print $1}'",
-            )
-            all_services = (
-                set(services_raw_str.strip().splitlines())
-                if services_raw_str
-                else set()
-            )
-
-        except Exception:
-            all_services = set()
-
-        try:
-            enabled_services_raw_str = host.get_fact(
-                Command,
-                "systemctl list-unit-files --type=service --state=enabled | grep -Ev 'getty|timesyncd|UNIT|unit' | awk '{print $1}'",
-            )
-            enabled_services_full = (
-                set(enabled_services_raw_str.strip().splitlines())
-                if enabled_services_raw_str
-                else set()
-            )
+            snapshot = host.get_fact(ServicesSnapshot)
         except Exception:
-            enabled_services_full = set()
+            snapshot = {}
 
-        enabled_services = {
-            s for s in enabled_services_full if "@." not in s and "initrd" not in s
+        # Units only loaded at runtime have no unit file state.
+        all_services = {name for name, info in snapshot.items() if info["state"]}
+        enabled_services_full = {
+            name for name, info in snapshot.items() if info["state"] == "enabled"
         }
 
+        enabled_services = {s for s in enabled_services_full if is_managed(s)}
+
         declared_services = chobolo.get("services", [])
 
         return {
             "all_services": list(all_services),
             "enabled_services": list(enabled_services),
             "declared_services": declared_services,
+            "service_states": snapshot,
+            "service_ids": self._get_service_ids(
+                host, snapshot, declared_services, chobolo.get("factCache")
+            ),
+            "batchServices": chobolo.get("batchServices", False),
         }
 
+    def _get_service_ids(
+        self, host, snapshot: dict, declared_services: list, cache_options: Any
+    ) -> dict[str, str]:
+        """
+        Maps the declared names and the alias units of the host to their
+        canonical unit Ids, cached per host until its unit files change.
+        """
+        names = {
+            unit_name(config["name"])
+            for config in declared_services
+            if config.get("name") and not config.get("dense_service", False)
+        }
+        unresolved = sorted(
+            {
+                name
+                for name in names
+                if (snapshot.get(name) or {}).get("state") in (None, "alias")
+            }
+            | {name for name, info in snapshot.items() if info["state"] == "alias"}
+        )
+        if not unresolved:
+            return {}
+
+        cache = get_fact_cache("services-ids", cache_options)
+        fingerprint = unit_files_fingerprint(snapshot) if snapshot else None
+        ids = {}
+        if cache and fingerprint:
+            ids = cache.get(host.name, fingerprint) or {}
+
+        missing = [name for name in unresolved if name not in ids]
+        if missing:
+            try:
+                resolved = host.get_fact(ServiceIds, names=missing)
+            except Exception:
+                resolved = {}
+            else:
+                ids.update({name: resolved.get(name, name) for name in missing})
+                if cache and fingerprint:
+                    cache.set(host.name, fingerprint, ids)
+
+        return {name: ids[name] for name in unresolved if ids.get(name, name) != name}
+
     def delta(self, context: dict[str, Any] = {}) -> Delta:
-        all_services = set(context.get("all_services", []))
+        index = ServiceIndex(context.get("all_services", []))
         enabled_services = set(context.get("enabled_services", []))
         declared_services = context.get("declared_services", [])
 
+        service_ids = context.get("service_ids") or {}
+        enabled_services = {service_ids.get(s, s) for s in enabled_services}
+
         expanded_desired_services = set()
         service_name_to_config = {}
 
@@ -116,24 +411,53 @@ class ServicesRole(Role):
                 continue
 
             if service_config.get("dense_service", False):
-                for s in all_services:
-                    # Filter out template units and initrd services
-                    if "@." in s or "initrd" in s:
-                        continue
-                    if s.startswith(service_name):
-                        expanded_desired_services.add(s)
-                        service_name_to_config[s] = service_config
+                for s in index.with_prefix(service_name):
+                    s = service_ids.get(s, s)
+                    expanded_desired_services.add(s)
+                    service_name_to_config[s] = service_config
 
             else:
-                if not service_name.endswith(".service"):
-                    service_name = f"{service_name}.service"
+                # Aliases are managed under their canonical unit.
+                service_name = unit_name(service_name)
+                service_name = service_ids.get(service_name, service_name)
                 expanded_desired_services.add(service_name)
                 service_name_to_config[service_name] = service_config
 
-        to_add_names = expanded_desired_services - enabled_services
-        to_remove_names = (
-            enabled_services - expanded_desired_services
-        ) - SERVICES_BLACKLIST
+        states = context.get("service_states")
+        divergence = {}
+        for s in expanded_desired_services:
+            config = service_name_to_config[s]
+            if not states:
+                # Without runtime states only the unit file state is known.
+                diverged = s not in enabled_services
+                divergence[s] = {"enabled": diverged, "running": diverged}
+                continue
+            info = states.get(s) or {}
+            enabled_diverged = (s in enabled_services) != bool(
+                config.get("on_boot", True)
+            )
+            if info.get("state") in FIXED_UNIT_STATES:
+                enabled_diverged = False
+            running_diverged = is_running_diverged(
+                info, bool(config.get("running", True))
+            )
+            divergence[s] = {"enabled": enabled_diverged, "running": running_diverged}
+
+        to_remove_names = {
+            s
+            for s in enabled_services - expanded_desired_services
+            if not is_blacklisted(s)
+        }
+        for s in to_remove_names:
+            info = (states or {}).get(s) or {}
+            divergence[s] = {
+                "enabled": True,
+                "running": not states or info.get("active") in ACTIVE_STATES,
+            }
+
+        to_add_names = {
+            s for s in expanded_desired_services if any(divergence[s].values())
+        }
 
         to_add = sorted(list(to_add_names))
         to_remove = sorted(list(to_remove_names))
@@ -149,7 +473,11 @@ class ServicesRole(Role):
         return Delta(
             to_add=delta_to_add,
             to_remove=delta_to_remove,
-            metadata={"config_map": service_name_to_config},
+            metadata={
+                "config_map": service_name_to_config,
+                "divergence": divergence,
+                "batch": bool(context.get("batchServices")),
+            },
         )
 
     def plan(self, state, host, delta: Delta = Delta()) -> ResultPayload:
@@ -158,6 +486,16 @@ class ServicesRole(Role):
         config_map = delta.metadata.get("config_map", {})
 
         try:
+            if delta.metadata.get("batch"):
+                self._plan_batch(
+                    state,
+                    to_add,
+                    to_remove,
+                    config_map,
+                    delta.metadata.get("divergence", {}),
+                )
+                return ResultPayload(success=True, message=[], error=[], data={})
+
             for service_name in to_add:
                 config = config_map.get(service_name, {})
                 s_state = config.get("running", True)
@@ -191,3 +529,39 @@ class ServicesRole(Role):
                 error=[f"Error planning services role: {str(e)}"],
                 data={},
             )
+
+    def _plan_batch(
+        self,
+        state,
+        to_add: list[str],
+        to_remove: list[str],
+        config_map: dict[str, Any],
+        divergence: dict[str, dict[str, bool]],
+    ) -> None:
+        if not to_add and not to_remove:
+            return
+
+        # Only the diverging axis of each service is acted upon.
+        both = {"enabled": True, "running": True}
+        enable, disable, start, stop = [], [], [], []
+        for service_name in to_add:
+            config = config_map.get(service_name, {})
+            diverged = divergence.get(service_name, both)
+            if diverged["enabled"]:
+                enabled = config.get("on_boot", True)
+                (enable if enabled else disable).append(service_name)
+            if diverged["running"]:
+                running = config.get("running", True)
+                (start if running else stop).append(service_name)
+        for service_name in to_remove:
+            disable.append(service_name)
+            if divergence.get(service_name, both)["running"]:
+                stop.append(service_name)
+
+        add_op(
+            state,
+            server.shell,
+            name=f"Apply {len(to_add) + len(to_remove)} service changes in one batch",
+            commands=[build_systemctl_command(enable, disable, start, stop)],
+            _sudo=True,
+        )
@@ -0,0 +1,321 @@
+import ctypes
+import ctypes.util
+import functools
+import hashlib
+import hmac
+import multiprocessing
+import os
+import pickle
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable
+
+from passlib.exc import MissingBackendError
+from passlib.hash import bcrypt, md5_crypt, sha256_crypt, sha512_crypt
+
+from charonte.lib.cache import FactCache
+
+VERIFY_CACHE_TTL = 30 * 24 * 60 * 60
+CONFIG_DIR_ENV = "CHARONTE_CONFIG_DIR"
+# Below this many jobs, starting the workers costs more than it saves.
+POOL_MIN_JOBS = 4
+# Sizes of libxcrypt's struct crypt_data and CRYPT_GENSALT_OUTPUT_SIZE.
+CRYPT_DATA_SIZE = 32768
+CRYPT_GENSALT_SIZE = 192
+CRYPT_ALPHABET = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+# Schemes passlib implements itself. Anything else ($y$ yescrypt, the Arch
+# default, $gy$, $7$, ...) goes through the controller's libcrypt.
+PASSLIB_SCHEMES = {
+    "6": sha512_crypt,
+    "5": sha256_crypt,
+    "1": md5_crypt,
+    "2a": bcrypt,
+    "2b": bcrypt,
+    "2y": bcrypt,
+}
+
+# Verdicts are memoized for the whole run under a digest keyed with a
+# per-process secret, so no pair is ever verified twice.
+_run_key = secrets.token_bytes(32)
+_verdicts: dict[str, bool] = {}
+_pool: ProcessPoolExecutor | None = None
+_pool_workers = 0
+
+
+def hash_scheme(hashed: str | None) -> str | None:
+    if not hashed or not hashed.startswith("$") or hashed.count("$") < 2:
+        return None
+    return hashed.split("$")[1]
+
+
+@functools.lru_cache(maxsize=None)
+def _load_libcrypt() -> ctypes.CDLL | None:
+    """
+    Loads the controller's libcrypt (libxcrypt on current distributions)
+    through ctypes, as the `crypt` module is gone since Python 3.13.
+    """
+    name = ctypes.util.find_library("crypt")
+    if not name:
+        return None
+    try:
+        lib = ctypes.CDLL(name)
+    except OSError:
+        return None
+
+    if hasattr(lib, "crypt_rn"):
+        lib.crypt_rn.restype = ctypes.c_char_p
+        lib.crypt_rn.argtypes = [
+            ctypes.c_char_p,
+            ctypes.c_char_p,
+            ctypes.c_void_p,
+            ctypes.c_int,
+        ]
+    elif hasattr(lib, "crypt"):
+        lib.crypt.restype = ctypes.c_char_p
+        lib.crypt.argtypes = [ctypes.c_char_p, ctypes.c_char_p]
+    else:
+        return None
+
+    if hasattr(lib, "crypt_gensalt_rn"):
+        lib.crypt_gensalt_rn.restype = ctypes.c_char_p
+        lib.crypt_gensalt_rn.argtypes = [
+            ctypes.c_char_p,
+            ctypes.c_ulong,
+            ctypes.c_char_p,
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_int,
+        ]
+    return lib
+
+
+def _libc_crypt(password: str, setting: str) -> str | None:
+    lib = _load_libcrypt()
+    if lib is None:
+        return None
+    phrase, salt = password.encode("utf-8"), setting.encode("ascii", "replace")
+    if hasattr(lib, "crypt_rn"):
+        data = ctypes.create_string_buffer(CRYPT_DATA_SIZE)
+        result = lib.crypt_rn(phrase, salt, data, CRYPT_DATA_SIZE)
+    else:
+        result = lib.crypt(phrase, salt)
+    # crypt(3) signals unsupported settings with NULL, "*0" or "*1".
+    if not result or result.startswith(b"*"):
+        return None
+    return result.decode("ascii")
+
+
+def _libc_gensalt(prefix: str) -> str | None:
+    lib = _load_libcrypt()
+    if lib is None or not hasattr(lib, "crypt_gensalt_rn"):
+        return None
+    output = ctypes.create_string_buffer(CRYPT_GENSALT_SIZE)
+    result = lib.crypt_gensalt_rn(
+        prefix.encode("ascii"), 0, None, 0, output, CRYPT_GENSALT_SIZE
+    )
+    if not result or result.startswith(b"*"):
+        return None
+    return result.decode("ascii")
+
+
+def hash_password(password: str, like: str | None = None) -> str:
+    """
+    Hashes `password` with sha512_crypt, or with the scheme of the `like` hash
+    when the controller supports it.
+    """
+    scheme = hash_scheme(like)
+    if scheme is None:
+        return sha512_crypt.hash(password)
+
+    handler = PASSLIB_SCHEMES.get(scheme)
+    if handler is not None:
+        try:
+            return handler.hash(password)
+        except MissingBackendError:
+            pass
+
+    parts = like.split("$")
+    if len(parts) >= 4:
+        salt = "".join(secrets.choice(CRYPT_ALPHABET) for _ in parts[-2])
+        result = _libc_crypt(password, "$".join([*parts[:-2], salt]))
+        if result:
+            return result
+        # Some schemes encode their salt, so let libcrypt make a fresh one.
+        setting = _libc_gensalt(f"${scheme}$")
+        result = _libc_crypt(password, setting) if setting else None
+        if result:
+            return result
+    return sha512_crypt.hash(password)
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Returns the pool shared by every host of the run, with at least `workers`
+    processes: it is started on first use and restarted when a caller asks
+    for more workers than it has.
+
+    Workers are spawned rather than forked, as forking pyinfra's threaded
+    controller can leave a child stuck on a lock held by another thread.
+    """
+    global _pool, _pool_workers
+    if _pool is not None and workers > _pool_workers:
+        _reset_pool()
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        _pool_workers = workers
+    return _pool
+
+
+def _reset_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _picklable(obj: Any) -> bool:
+    try:
+        pickle.dumps(obj)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+    return True
+
+
+def run_parallel(
+    func: Callable[..., Any], jobs: list[tuple], workers: int | None = None
+) -> list[Any]:
+    """
+    Calls `func` with each job's arguments in the run's process pool, which
+    has at least `workers` processes (one per controller core by default, see
+    `_get_pool`), returning the results in job order. Small batches, a single
+    worker and pools that cannot start run serially, as do callables the
+    workers cannot receive: a pickling failure inside the pool breaks it
+    beyond a clean shutdown.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(jobs) >= POOL_MIN_JOBS and _picklable(func):
+        try:
+            return list(_get_pool(workers).map(func, *zip(*jobs)))
+        except Exception:
+            _reset_pool()
+    return [func(*job) for job in jobs]
+
+
+def hash_passwords(
+    jobs: list[tuple[str, str | None]], workers: int | None = None
+) -> list[str]:
+    """
+    Hashes each `(password, like)` job, see `hash_password`.
+    """
+    return run_parallel(hash_password, jobs, workers)
+
+
+def _verify_hash(password: str, hashed: str) -> bool:
+    handler = PASSLIB_SCHEMES.get(hash_scheme(hashed) or "")
+    if handler is not None:
+        try:
+            return handler.verify(password, hashed)
+        except MissingBackendError:
+            pass
+        except ValueError:
+            return False
+
+    result = _libc_crypt(password, hashed)
+    return result is not None and hmac.compare_digest(result, hashed)
+
+
+def _key_path() -> Path:
+    root = os.environ.get(CONFIG_DIR_ENV)
+    if root:
+        return Path(root) / "verify.key"
+    xdg_config = os.environ.get("XDG_CONFIG_HOME") or str(Path.home() / ".config")
+    return Path(xdg_config) / "charonte" / "verify.key"
+
+
+def _load_key(path: Path) -> bytes | None:
+    try:
+        return path.read_bytes()
+    except OSError:
+        pass
+
+    key = secrets.token_bytes(32)
+    try:
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+    except FileExistsError:
+        return path.read_bytes()
+    except OSError:
+        return None
+    return key
+
+
+class PasswordVerifier:
+    """
+    Verifies plaintext passwords against crypt hashes at most once per run.
+
+    With a cache, verdicts also persist between runs. They are stored under an
+    HMAC of the pair, so neither the password nor the hash is ever written.
+    The HMAC key lives in the user's private config directory, never in the
+    cache: with both, the stored verdicts would be a fast offline oracle for
+    guessing passwords against known hashes.
+    """
+
+    def __init__(self, cache: FactCache | None = None):
+        self.cache = cache
+        self.key = _run_key
+        if cache:
+            # Keys from older releases were kept next to the verdicts.
+            (cache.directory / "hmac.key").unlink(missing_ok=True)
+            key = _load_key(_key_path())
+            if key:
+                self.key = key
+            else:
+                self.cache = None
+
+    def _digest(self, password: str, hashed: str) -> str:
+        message = f"{password}\0{hashed}".encode("utf-8")
+        return hmac.new(self.key, message, hashlib.sha256).hexdigest()
+
+    def prefetch(
+        self, pairs: list[tuple[str, str]], workers: int | None = None
+    ) -> None:
+        """
+        Verifies every pair that is neither memoized nor cached in one parallel
+        batch, so the `verify` calls that follow are lookups.
+        """
+        missing: dict[str, tuple[str, str]] = {}
+        for password, hashed in pairs:
+            digest = self._digest(password, hashed)
+            if digest in _verdicts or digest in missing:
+                continue
+            verdict = self.cache.get(digest, "verify") if self.cache else None
+            if verdict is not None:
+                _verdicts[digest] = verdict
+            else:
+                missing[digest] = (password, hashed)
+
+        verdicts = run_parallel(_verify_hash, list(missing.values()), workers)
+        for digest, verdict in zip(missing, verdicts):
+            _verdicts[digest] = verdict
+            if self.cache:
+                self.cache.set(digest, "verify", verdict)
+
+    def verify(self, password: str, hashed: str) -> bool:
+        digest = self._digest(password, hashed)
+        if digest in _verdicts:
+            return _verdicts[digest]
+
+        verdict = self.cache.get(digest, "verify") if self.cache else None
+        if verdict is None:
+            verdict = _verify_hash(password, hashed)
+            if self.cache:
+                self.cache.set(digest, "verify", verdict)
+
+        _verdicts[digest] = verdict
+        return verdict
@@ -1,84 +1,198 @@
 import base64
+import posixpath
+import shlex
 from io import StringIO
 from typing import Any, Optional
 
 from chaos.lib.args.dataclasses import Delta, ResultPayload
 from chaos.lib.roles.role import Role
-from passlib.hash import sha512_crypt
+from pyinfra.api import FactBase
 from pyinfra.api.operation import add_op
-from pyinfra.facts.server import Command, Users
 from pyinfra.operations import files, server
 
+from charonte.lib.cache import get_fact_cache
+from charonte.roles.users.tasks.passwords import (
+    VERIFY_CACHE_TTL,
+    PasswordVerifier,
+    hash_passwords,
+)
+
+USERS_SCRIPT_PATH = "/run/charonte-users.sh"
+SUDOERS_DIR = "/etc/sudoers.d"
+MERGED_BIN_DIRS = {"/bin", "/sbin", "/usr/bin", "/usr/sbin"}
+
+
+def canonical_path(path: Optional[str]) -> Optional[str]:
+    """
+    Normalizes `path` for comparison, folding the merged /bin, /sbin and
+    /usr/sbin into /usr/bin.
+    """
+    if not path:
+        return None
+    path = posixpath.normpath(path)
+    directory, name = posixpath.split(path)
+    if directory in MERGED_BIN_DIRS:
+        return f"/usr/bin/{name}"
+    return path
+
+
+def resolve_shell(shell: str, login_shells: Optional[list[str]] = None) -> str:
+    """
+    Returns the path of `shell`, a path or a bare name looked up in the host's
+    /etc/shells, falling back to /bin/<name>.
+    """
+    if shell.startswith("/"):
+        return shell
+    default = f"/bin/{shell}"
+    candidates = [
+        entry for entry in login_shells or [] if posixpath.basename(entry) == shell
+    ]
+    if not candidates or default in candidates:
+        return default
+    return candidates[0]
+
+
+class UsersSnapshot(FactBase):
+    """
+    Returns, in one privileged call and as lines keyed by section, the passwd
+    and shadow entries of the declared users, the names of the other regular
+    users, the groups that matter to the declared users, the managed sudoers
+    files, the login shells and the hostname.
+
+    Everything is filtered on the host, so the output grows with the declared
+    users rather than with the account database.
+    """
+
+    def command(self, names: list[str], groups: Optional[list[str]] = None) -> str:
+        wanted = shlex.quote(" " + " ".join(names) + " ")
+        wanted_groups = shlex.quote(" " + " ".join(groups or []) + " ")
+        return (
+            "echo '##passwd'; "
+            f"awk -F: -v wanted={wanted} "
+            '\'index(wanted, " " $1 " ")\' /etc/passwd; '
+            "echo '##regular'; "
+            "awk -F: '$3 >= 1000 { print $1 }' /etc/passwd; "
+            # Primary groups of the declared users, the groups they declare
+            # and the groups they are members of.
+            "echo '##group'; "
+            f"awk -F: -v wanted={wanted} -v groups={wanted_groups} "
+            '\'NR == FNR { if (index(wanted, " " $1 " ")) gids[$4] = 1; next } '
+            '($3 in gids) || index(groups, " " $1 " ") { print; next } '
+            '{ n = split($4, members, ","); for (i = 1; i <= n; i++) '
+            'if (index(wanted, " " members[i] " ")) { print; next } }\' '
+            "/etc/passwd /etc/group; "
+            "echo '##shadow'; "
+            f"awk -F: -v wanted={wanted} "
+            '\'index(wanted, " " $1 " ") { print $1 ":" $2 }\' /etc/shadow; '
+            "echo '##sudoers'; "
+            "for f in /etc/sudoers.d/99-charonte-*; do "
+            'if [ -f "$f" ]; then '
+            'echo "${f##*/}|$(base64 < "$f" | tr -d \'\\n\')"; fi; done; '
+            "echo '##shells'; grep '^/' /etc/shells 2>/dev/null; "
+            "echo '##hostname'; cat /etc/hostname 2>/dev/null; true"
+        )
+
+    default = dict
+
+    def process(self, output) -> dict[str, list[str]]:
+        sections: dict[str, list[str]] = {}
+        current = None
+        for line in output:
+            if line.startswith("##"):
+                current = sections.setdefault(line[2:].strip(), [])
+            elif current is not None and line.strip():
+                current.append(line.strip())
+        return sections
+
 
 class BaseUsersRole(Role):
     """
     Base class for UsersRole containing the helper functions for context, delta, and plan generation.
     """
 
-    def _get_users_context(self, host, context: dict[str, Any]) -> None:
-        all_users = host.get_fact(Users) or {}
-
+    def _get_snapshot_context(self, host, context: dict[str, Any]) -> None:
+        users = context.get("users") or []
+        names = sorted({user.get("name") for user in users if user.get("name")})
+        groups = sorted({group for user in users for group in user.get("groups") or []})
+        # An empty account database would make every declared user look new
+        # and every rule missing, so a failed snapshot is not papered over.
+        snapshot = host.get_fact(UsersSnapshot, names=names, groups=groups, _sudo=True)
+        if not snapshot or "passwd" not in snapshot or "regular" not in snapshot:
+            raise RuntimeError("Could not read the account database of the host.")
+
+        all_users = self._parse_accounts(
+            snapshot.get("passwd", []), snapshot.get("group", [])
+        )
         context["existing_users"] = {
-            name
-            for name, info in all_users.items()
-            if info.get("uid", 0) >= 1000 and name != "nobody"
+            name for name in snapshot.get("regular", []) if name != "nobody"
         }
-
         context["system_users"] = {
             name for name, info in all_users.items() if info.get("uid", 0) < 1000
         }
-
         context["all_users_info"] = all_users
+        context["existing_groups"] = {
+            line.split(":", 1)[0] for line in snapshot.get("group", []) if ":" in line
+        }
 
-    def _get_sudoers_context(self, host, context: dict[str, Any]) -> None:
-        try:
-            sudo_cmd = r"""for f in /etc/sudoers.d/99-charonte-*; do if [ -f "$f" ]; then echo "${f##*/}|$(base64 < "$f" | tr -d '\n')"; fi; done"""
-            actual_files_output = host.get_fact(
-                Command,
-                sudo_cmd,
-                _sudo=True,
-            )
-
-            managed_sudo_files = {}
-
-            if actual_files_output:
-                for line in actual_files_output.strip().splitlines():
-                    if "|" in line:
-                        name, b64_content = line.split("|", 1)
-                        try:
-                            managed_sudo_files[name] = base64.b64decode(
-                                b64_content
-                            ).decode("utf-8")
-                        except Exception:
-                            pass
-
-            context["managed_sudo_files"] = managed_sudo_files
-
-        except Exception:
-            context["managed_sudo_files"] = {}
-
-    def _get_shadow_context(self, host, context: dict[str, Any]) -> None:
-        try:
-            shadow_output = host.get_fact(Command, "cat /etc/shadow", _sudo=True)
-            shadow_hashes = {}
-
-            if shadow_output:
-                for line in shadow_output.strip().splitlines():
-                    parts = line.split(":")
-                    if len(parts) >= 2:
-                        shadow_hashes[parts[0]] = parts[1]
-
-            context["shadow_hashes"] = shadow_hashes
-        except Exception:
-            context["shadow_hashes"] = {}
-
-    def _get_hostname_context(self, host, context: dict[str, Any]) -> None:
-        try:
-            hostname_output = host.get_fact(Command, "cat /etc/hostname", _sudo=True)
-            if hostname_output:
-                context["current_hostname"] = hostname_output.strip()
-        except Exception:
-            context["current_hostname"] = None
+        shadow_hashes = {}
+        for line in snapshot.get("shadow", []):
+            parts = line.split(":")
+            if len(parts) >= 2:
+                shadow_hashes[parts[0]] = parts[1]
+        context["shadow_hashes"] = shadow_hashes
+
+        managed_sudo_files = {}
+        for line in snapshot.get("sudoers", []):
+            if "|" in line:
+                name, b64_content = line.split("|", 1)
+                try:
+                    managed_sudo_files[name] = base64.b64decode(b64_content).decode(
+                        "utf-8"
+                    )
+                except Exception:
+                    pass
+        context["managed_sudo_files"] = managed_sudo_files
+
+        context["login_shells"] = snapshot.get("shells", [])
+
+        hostname = snapshot.get("hostname", [])
+        context["current_hostname"] = hostname[0].strip() if hostname else None
+
+    @staticmethod
+    def _parse_accounts(
+        passwd: list[str], group: list[str]
+    ) -> dict[str, dict[str, Any]]:
+        group_names = {}
+        members: dict[str, list[str]] = {}
+        for line in group:
+            parts = line.split(":")
+            if len(parts) < 4:
+                continue
+            group_names[parts[2]] = parts[0]
+            for member in filter(None, parts[3].split(",")):
+                members.setdefault(member, []).append(parts[0])
+
+        users = {}
+        for line in passwd:
+            parts = line.split(":")
+            if len(parts) < 7:
+                continue
+            name, _, uid, gid, comment, home, shell = parts[:7]
+            primary = group_names.get(gid)
+            try:
+                uid_number, gid_number = int(uid), int(gid)
+            except ValueError:
+                continue
+            users[name] = {
+                "home": home or None,
+                "comment": comment or None,
+                "shell": shell or None,
+                "group": primary,
+                "groups": [g for g in members.get(name, []) if g != primary],
+                "uid": uid_number,
+                "gid": gid_number,
+            }
+        return users
 
     def _compute_users_delta(
         self,
@@ -94,13 +208,39 @@ class BaseUsersRole(Role):
         all_users_info = safe_context.get("all_users_info", {})
         shadow_hashes = safe_context.get("shadow_hashes", {})
         user_pass = safe_context.get("secrets", {}).get("user_secrets", {})
+        verifier = self._get_password_verifier(safe_context)
+        keep_scheme = bool(safe_context.get("keepHashScheme"))
 
         users_to_remove = sorted(existing_users - user_list_from_chobolo)
         if users_to_remove:
             to_remove["users"] = users_to_remove
 
+        workers = safe_context.get("hashWorkers")
+        passwords = {
+            user["name"]: user_pass.get(user["name"], {}).get("password")
+            for user in chobolo_users
+            if user["name"] not in system_users
+        }
+        verifier.prefetch(
+            [
+                (password, shadow_hashes[name])
+                for name, password in passwords.items()
+                if password
+                and not password.startswith("$")
+                and shadow_hashes.get(name, "").startswith("$")
+            ],
+            workers,
+        )
+
         users_for_vitrine = []
         users_to_enforce = []
+        user_hashes = {}
+        to_hash = []
+        login_shells = safe_context.get("login_shells") or []
+        user_shells = {
+            user["name"]: resolve_shell(user.get("shell", "bash"), login_shells)
+            for user in chobolo_users
+        }
 
         for u in chobolo_users:
             name = u["name"]
@@ -114,15 +254,21 @@ class BaseUsersRole(Role):
             else:
                 existing_info = all_users_info.get(name, {})
 
-                desired_shell = f"/bin/{u.get('shell', 'bash')}"
-                if existing_info.get("shell") != desired_shell:
+                if canonical_path(existing_info.get("shell")) != canonical_path(
+                    user_shells[name]
+                ):
                     needs_update = True
 
                 desired_home = u.get("home", f"/home/{name}")
-                if existing_info.get("home") != desired_home:
+                if canonical_path(existing_info.get("home")) != canonical_path(
+                    desired_home
+                ):
                     needs_update = True
 
-                desired_groups = set(u.get("groups") or [])
+                # The primary group is never listed as a supplementary one.
+                desired_groups = set(u.get("groups") or []) - {
+                    existing_info.get("group")
+                }
                 existing_groups = set(existing_info.get("groups") or [])
 
                 if not desired_groups == existing_groups:
@@ -138,10 +284,7 @@ class BaseUsersRole(Role):
                             needs_update = True
                     else:
                         if existing_hash.startswith("$"):
-                            try:
-                                if not sha512_crypt.verify(password, existing_hash):
-                                    needs_update = True
-                            except ValueError:
+                            if not verifier.verify(password, existing_hash):
                                 needs_update = True
                         else:
                             needs_update = True
@@ -149,15 +292,78 @@ class BaseUsersRole(Role):
             if needs_update:
                 users_for_vitrine.append(name)
                 users_to_enforce.append(u)
+                password = user_pass.get(name, {}).get("password")
+                if password:
+                    existing_hash = shadow_hashes.get(name)
+                    reused = self._reusable_password_hash(
+                        password, existing_hash, verifier
+                    )
+                    if reused:
+                        user_hashes[name] = reused
+                    else:
+                        like = existing_hash if keep_scheme else None
+                        to_hash.append((name, password, like))
+
+        # New hashes are pure CPU work, so they are computed in one batch.
+        new_hashes = hash_passwords(
+            [(password, like) for _, password, like in to_hash], workers
+        )
+        for (name, _, _), hashed in zip(to_hash, new_hashes):
+            user_hashes[name] = hashed
 
         if users_for_vitrine:
             to_add["users"] = users_for_vitrine
 
         metadata["enforce_users"] = users_to_enforce
+        metadata["user_shells"] = {
+            user["name"]: user_shells[user["name"]] for user in users_to_enforce
+        }
+
+        # Groups already on the host are left alone instead of being
+        # re-asserted on every run.
+        existing_groups = safe_context.get("existing_groups")
+        wanted_groups = {
+            group for user in users_to_enforce for group in user.get("groups") or []
+        }
+        if existing_groups is not None:
+            wanted_groups -= set(existing_groups)
+        metadata["create_groups"] = sorted(wanted_groups)
+        metadata["new_users"] = [
+            user["name"]
+            for user in users_to_enforce
+            if user["name"] not in existing_users
+        ]
+        metadata["bulk_users"] = bool(safe_context.get("bulkUsers"))
 
         metadata["shadow_hashes"] = shadow_hashes
 
-        metadata["user_pass"] = user_pass
+        metadata["user_hashes"] = user_hashes
+
+    @staticmethod
+    def _get_password_verifier(safe_context: dict[str, Any]) -> PasswordVerifier:
+        cache = None
+        if safe_context.get("verifyCache"):
+            cache = get_fact_cache(
+                "users-verify", safe_context.get("factCache"), VERIFY_CACHE_TTL
+            )
+        return PasswordVerifier(cache)
+
+    @staticmethod
+    def _reusable_password_hash(
+        password: str,
+        existing_hash: str | None,
+        verifier: PasswordVerifier,
+    ) -> str | None:
+        """
+        Returns the hash to apply when no new one is needed: a pre-hashed
+        password, or the current hash when it still matches.
+        """
+        if password.startswith("$"):
+            return password
+        if existing_hash and existing_hash.startswith("$"):
+            if verifier.verify(password, existing_hash):
+                return existing_hash
+        return None
 
     def _compute_sudo_delta(
         self,
@@ -209,100 +415,200 @@ class BaseUsersRole(Role):
 
     def _plan_sudo_rules(self, state, host, safe_delta: Delta) -> None:
         sudo_rules_to_remove = safe_delta.to_remove.get("sudo_rules", [])
-        for filename in sudo_rules_to_remove:
-            add_op(
-                state,
-                files.file,
-                name=f"Remove old sudo rule {filename}",
-                path=f"/etc/sudoers.d/{filename}",
-                present=False,
-                _sudo=True,
-            )
-
         sudo_rules_to_enforce = safe_delta.metadata.get("enforce_sudo_rules", {})
-        for filename, content in sudo_rules_to_enforce.items():
-            tmp_path = f"/tmp/{filename}"
-            final_path = f"/etc/sudoers.d/{filename}"
-
-            add_op(
-                state,
-                files.put,
-                name=f"Upload sudo rule {filename} to temporary location",
-                src=StringIO(content),
-                dest=tmp_path,
-                mode="0440",
-                user="root",
-                group="root",
-                _sudo=True,
-            )
-
-            add_op(
-                state,
-                server.shell,
-                name=f"Validate sudo rule {filename}",
-                commands=[f"visudo -c -f {tmp_path}"],
-                _sudo=True,
-            )
-
-            add_op(
-                state,
-                server.shell,
-                name=f"Deploy validated sudo rule {filename}",
-                commands=[f"mv {tmp_path} {final_path}"],
-                _sudo=True,
-            )
+        if not sudo_rules_to_remove and not sudo_rules_to_enforce:
+            return
+
+        add_op(
+            state,
+            server.shell,
+            name=(
+                f"Deploy {len(sudo_rules_to_enforce)} and remove "
+                f"{len(sudo_rules_to_remove)} sudo rules"
+            ),
+            commands=[
+                build_sudoers_command(sudo_rules_to_enforce, sudo_rules_to_remove)
+            ],
+            _sudo=True,
+        )
 
     def _plan_users(self, state, host, safe_delta: Delta, errors: list) -> None:
+        if safe_delta.metadata.get("bulk_users"):
+            self._plan_users_bulk(state, host, safe_delta, errors)
+            return
+
         users_to_remove = safe_delta.to_remove.get("users", [])
         for user_name in users_to_remove:
             add_op(state, server.user, user=user_name, present=False, _sudo=True)
 
         user_details_list = safe_delta.metadata.get("enforce_users", [])
-        user_pass = safe_delta.metadata.get("user_pass", {})
-        shadow_hashes = safe_delta.metadata.get("shadow_hashes", {})
+        user_hashes = safe_delta.metadata.get("user_hashes", {})
+        user_shells = safe_delta.metadata.get("user_shells", {})
 
         if user_details_list:
-            groups_to_add = {
-                group
-                for user_details in user_details_list
-                for group in user_details.get("groups", [])
-            }
-
-            for group_name in groups_to_add:
+            for group_name in safe_delta.metadata.get("create_groups", []):
                 add_op(state, server.group, group=group_name, present=True, _sudo=True)
 
             for user_details in user_details_list:
                 username = user_details["name"]
-                password = user_pass.get(username, {}).get("password")
+                password = user_hashes.get(username)
                 if not password:
                     errors.append(f"NO_PASSWORD_FOR_USER:{username}")
 
-                if password and not password.startswith("$"):
-                    existing_hash = shadow_hashes.get(username)
-                    if existing_hash and existing_hash.startswith("$"):
-                        try:
-                            if sha512_crypt.verify(password, existing_hash):
-                                password = existing_hash
-                            else:
-                                password = sha512_crypt.hash(password)
-                        except ValueError:
-                            password = sha512_crypt.hash(password)
-                    else:
-                        password = sha512_crypt.hash(password)
-
                 add_op(
                     state,
                     server.user,
                     name=f"Manage user {username}",
                     user=username,
                     home=user_details.get("home", f"/home/{username}"),
-                    shell=f"/bin/{user_details.get('shell', 'bash')}",
+                    shell=user_shells.get(
+                        username, resolve_shell(user_details.get("shell", "bash"))
+                    ),
                     groups=user_details.get("groups"),
                     password=password,
                     present=True,
                     _sudo=True,
                 )
 
+    def _plan_users_bulk(self, state, host, safe_delta: Delta, errors: list) -> None:
+        user_details_list = safe_delta.metadata.get("enforce_users", [])
+        user_hashes = safe_delta.metadata.get("user_hashes", {})
+        for user_details in user_details_list:
+            if not user_hashes.get(user_details["name"]):
+                errors.append(f"NO_PASSWORD_FOR_USER:{user_details['name']}")
+
+        script = build_users_script(
+            users_to_remove=safe_delta.to_remove.get("users", []),
+            users=user_details_list,
+            new_users=safe_delta.metadata.get("new_users", []),
+            groups=safe_delta.metadata.get("create_groups", []),
+            hashes=user_hashes,
+            shells=safe_delta.metadata.get("user_shells", {}),
+        )
+        if not script:
+            return
+
+        add_op(
+            state,
+            files.put,
+            name="Upload user management script",
+            src=StringIO(script),
+            dest=USERS_SCRIPT_PATH,
+            mode="0600",
+            user="root",
+            group="root",
+            _sudo=True,
+        )
+        add_op(
+            state,
+            server.shell,
+            name=f"Apply {len(user_details_list)} users in bulk",
+            commands=[
+                f"sh {USERS_SCRIPT_PATH}; rc=$?; rm -f {USERS_SCRIPT_PATH}; exit $rc"
+            ],
+            _sudo=True,
+        )
+
+
+def build_users_script(
+    users_to_remove: list[str],
+    users: list[dict[str, Any]],
+    new_users: list[str],
+    groups: list[str],
+    hashes: dict[str, str],
+    shells: Optional[dict[str, str]] = None,
+) -> str:
+    """
+    Builds the shell script applying every user, group and password change of
+    a host at once, passwords through a single `chpasswd -e` batch.
+    """
+    lines = []
+    for group in groups:
+        quoted = shlex.quote(group)
+        lines.append(f"getent group {quoted} >/dev/null || groupadd {quoted}")
+
+    for name in users_to_remove:
+        lines.append(f"userdel {shlex.quote(name)}")
+
+    for user in users:
+        name = user["name"]
+        home = user.get("home", f"/home/{name}")
+        groups_option = ",".join(user.get("groups") or [])
+        options = [
+            "-d",
+            shlex.quote(home),
+            "-s",
+            shlex.quote(
+                (shells or {}).get(name) or resolve_shell(user.get("shell", "bash"))
+            ),
+        ]
+        # usermod needs an empty list to drop groups, useradd rejects one.
+        if groups_option or name not in new_users:
+            options.extend(["-G", shlex.quote(groups_option)])
+        if name in new_users:
+            lines.append(f"useradd -m {' '.join(options)} {shlex.quote(name)}")
+        else:
+            lines.append(f"usermod {' '.join(options)} {shlex.quote(name)}")
+            lines.append(
+                f"[ -d {shlex.quote(home)} ] || install -d -m 0700 "
+                f'-o {shlex.quote(name)} -g "$(id -gn {shlex.quote(name)})" '
+                f"{shlex.quote(home)}"
+            )
+
+    entries = [
+        f"{user['name']}:{hashes[user['name']]}"
+        for user in users
+        if hashes.get(user["name"])
+    ]
+    if entries:
+        lines.append("chpasswd -e <<'CHARONTE_PASSWORDS'")
+        lines.extend(entries)
+        lines.append("CHARONTE_PASSWORDS")
+
+    if not lines:
+        return ""
+    return "set -e\n" + "\n".join(lines) + "\n"
+
+
+def build_sudoers_command(rules: dict[str, str], remove: list[str]) -> str:
+    """
+    Builds one command staging every sudo rule next to `SUDOERS_DIR`, checking
+    them with a single visudo call and only then moving them into place.
+
+    The staging directory has a dot in its name, so sudo never reads it, and
+    lives on the same filesystem, so each move is an atomic rename.
+    """
+    lines = ["set -e"]
+    if rules:
+        lines.extend(
+            [
+                f"stage=$(mktemp -d {SUDOERS_DIR}/.charonte.XXXXXX)",
+                "trap 'rm -rf \"$stage\"' EXIT",
+            ]
+        )
+        for filename, content in sorted(rules.items()):
+            lines.append(
+                f"cat > \"$stage\"/{shlex.quote(filename)} <<'CHARONTE_SUDOERS'"
+            )
+            lines.append(content.rstrip("\n"))
+            lines.append("CHARONTE_SUDOERS")
+        lines.extend(
+            [
+                'chmod 0440 "$stage"/*',
+                'cat "$stage"/* > "$stage/.check"',
+                'visudo -c -q -f "$stage/.check"',
+            ]
+        )
+        for filename in sorted(rules):
+            quoted = shlex.quote(filename)
+            lines.append(f'mv -f "$stage"/{quoted} {SUDOERS_DIR}/{quoted}')
+    if remove:
+        lines.append(
+            "rm -f "
+            + " ".join(f"{SUDOERS_DIR}/{shlex.quote(name)}" for name in sorted(remove))
+        )
+    return "\n".join(lines)
+
 
 class UsersRole(BaseUsersRole):
     """
@@ -313,7 +619,15 @@ class UsersRole(BaseUsersRole):
         super().__init__(
             name="Configure users and sudo access",
             needs_secrets=True,
-            necessary_chobolo_keys=["users", "hostname"],
+            necessary_chobolo_keys=[
+                "users",
+                "hostname",
+                "factCache",
+                "verifyCache",
+                "keepHashScheme",
+                "bulkUsers",
+                "hashWorkers",
+            ],
             necessary_secret_dict_keys=["user_secrets"],
         )
 
@@ -330,10 +644,7 @@ class UsersRole(BaseUsersRole):
         context = chobolo.copy()
         context["secrets"] = secrets
 
-        self._get_users_context(host, context)
-        self._get_sudoers_context(host, context)
-        self._get_shadow_context(host, context)
-        self._get_hostname_context(host, context)
+        self._get_snapshot_context(host, context)
 
         return context
 
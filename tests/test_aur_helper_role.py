@@ -0,0 +1,34 @@
+from unittest.mock import Mock
+
+from charonte.lib.pacman import get_transaction
+from charonte.roles.aurHelper.tasks import helper
+from charonte.roles.aurHelper.tasks.helper import AurHelperRole
+
+
+def test_privileged_flush_never_runs_makepkg(monkeypatch):
+    add_op = Mock()
+    monkeypatch.setattr(helper, "add_op", add_op)
+    monkeypatch.setattr(helper.pacman, "add_op", add_op)
+    state = Mock()
+    mock_host = Mock()
+    mock_host.name = "host-a"
+    mock_host.op_hash_order = []
+    mock_host.get_fact.return_value = True
+
+    delta = AurHelperRole().delta(
+        {
+            "declared_helpers": ["yay"],
+            "installed_helpers": {"yay": False},
+            "known_helpers": ["yay"],
+        }
+    )
+    AurHelperRole().plan(state, mock_host, delta)
+
+    build = add_op.call_args_list[0].kwargs
+    assert "_sudo" not in build
+    assert "makepkg --packagelist" in build["commands"][-1]
+
+    transaction = get_transaction(state, mock_host)
+    commands = transaction.commands(transaction.pending(transaction.flushes))
+    assert commands and not any("makepkg" in command for command in commands)
+    assert "$(cat /tmp/yay/.charonte-pkglist)" in commands[0]
@@ -0,0 +1,29 @@
+import time
+
+from charonte.lib.cache import FactCache, get_fact_cache
+
+
+def test_cache_hit_requires_matching_fingerprint(tmp_path):
+    cache = FactCache("pkgs", root=tmp_path)
+    cache.set("host-a", "fp1", {"native_packages": ["base"]})
+
+    assert cache.get("host-a", "fp1") == {"native_packages": ["base"]}
+    assert cache.get("host-a", "fp2") is None
+    assert cache.get("host-b", "fp1") is None
+
+
+def test_cache_entries_expire(tmp_path):
+    FactCache("pkgs", root=tmp_path).set("host-a", "fp1", ["base"])
+    time.sleep(0.01)
+    cache = FactCache("pkgs", ttl=0, root=tmp_path)
+
+    assert cache.get("host-a", "fp1") is None
+    assert cache.evict() == 1
+
+
+def test_cache_can_be_disabled(monkeypatch):
+    assert get_fact_cache("pkgs", False) is None
+    assert get_fact_cache("pkgs", {"enabled": False}) is None
+
+    monkeypatch.setenv("CHARONTE_NO_FACT_CACHE", "1")
+    assert get_fact_cache("pkgs") is None
@@ -0,0 +1,105 @@
+from unittest.mock import Mock
+
+from charonte.lib import pacman
+from charonte.lib.pacman import (
+    PREFETCH_WAIT,
+    PacmanTransaction,
+    chunk_targets,
+    chunked_commands,
+    get_transaction,
+    start_prefetch,
+)
+
+
+def test_transaction_coalesces_contributions():
+    transaction = PacmanTransaction()
+    transaction.contribute("install", ["linux", "vim"])
+    transaction.contribute("remove", ["nano"], "-Rcns")
+    transaction.contribute("install", ["vim", "git"])
+    transaction.contribute("install_deps", ["cmake", "git"])
+    transaction.contribute("upgrade", ["/tmp/yay.pkg.tar.zst"])
+    transaction.contribute("remove", ["paru"], "-Rcns")
+
+    token = transaction.register_flush()
+    commands = transaction.commands(transaction.pending(token))
+
+    invocations = [command.split("; ")[1].split(" || ")[0] for command in commands]
+    assert invocations == [
+        "pacman -S --needed --noconfirm --noprogressbar linux vim git cmake",
+        "pacman -Qq cmake 2>/dev/null | grep -Fx -e cmake | "
+        "xargs -r pacman -D --asdeps",
+        "pacman -U --needed --noconfirm --noprogressbar /tmp/yay.pkg.tar.zst",
+        "pacman -Qq nano paru 2>/dev/null | grep -Fx -e nano -e paru | "
+        "xargs -r pacman -Rcns --noconfirm --noprogressbar",
+    ]
+
+
+def test_barrier_only_runs_earlier_contributions():
+    transaction = PacmanTransaction()
+    transaction.contribute("install", ["base"])
+    transaction.register_flush()
+    transaction.contribute("install_deps", ["cmake"])
+    barrier = transaction.register_flush()
+    transaction.contribute("upgrade", ["app.pkg.tar.zst"])
+    last = transaction.register_flush()
+
+    pending = transaction.pending(barrier)
+    assert [c.targets for c in pending] == [["base"], ["cmake"]]
+
+    transaction.consumed += len(pending)
+    assert [c.targets for c in transaction.pending(last)] == [["app.pkg.tar.zst"]]
+
+
+def test_flushes_followed_by_other_ops_become_barriers():
+    transaction = PacmanTransaction()
+    native = transaction.register_flush(ops=3)
+    transaction.flush_ops[native] = 4
+    # The helper role clones with git right after the native flush.
+    helper = transaction.register_flush(ops=6)
+    transaction.flush_ops[helper] = 7
+    aur = transaction.register_flush(ops=7)
+    transaction.flush_ops[aur] = 8
+
+    assert transaction.runs(native)
+    assert not transaction.runs(helper)
+    assert transaction.runs(helper, barrier=True)
+    assert transaction.runs(aur)
+
+
+def test_prefetch_is_waited_for_before_installing(monkeypatch):
+    add_op = Mock()
+    monkeypatch.setattr(pacman, "add_op", add_op)
+    mock_host = Mock()
+    mock_host.name = "host-a"
+    state = Mock()
+
+    assert start_prefetch(state, mock_host, ["linux"])
+    # The download is an op, so planning (and --dry) never starts it.
+    mock_host.get_fact.assert_not_called()
+    command = add_op.call_args.kwargs["commands"][0]
+    assert "pacman -Sw --needed --noconfirm --noprogressbar linux" in command
+
+    transaction = get_transaction(state, mock_host)
+    barrier = transaction.register_flush()
+    assert transaction.commands(transaction.pending(barrier)) == [PREFETCH_WAIT]
+
+    transaction.contribute("install", ["linux"])
+    commands = transaction.commands(transaction.pending(barrier + 1))
+    assert commands[0] == PREFETCH_WAIT
+
+
+def test_chunks_are_bounded_by_count_and_size():
+    assert chunk_targets(["a", "b", "c"], max_targets=2) == [["a", "b"], ["c"]]
+    assert chunk_targets(["aaaa", "bbbb", "cc"], max_bytes=10) == [
+        ["aaaa", "bbbb"],
+        ["cc"],
+    ]
+
+
+def test_chunked_commands_quote_and_report_each_chunk():
+    commands = chunked_commands(["pacman", "-S"], ["vim", "a b", "git"], 2)
+
+    assert len(commands) == 2
+    assert "pacman -S vim 'a b' ||" in commands[0]
+    assert 'echo "pacman -S: chunk 1/2, 2 targets in' in commands[0]
+    assert "pacman -S git ||" in commands[1]
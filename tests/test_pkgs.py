@@ -0,0 +1,435 @@
+import http.client
+from unittest.mock import Mock
+
+import pytest
+
+from charonte.roles.pkgs.tasks import aur, pkgs
+from charonte.roles.pkgs.tasks.aur import (
+    AurArtifactStore,
+    build_level_command,
+    plan_aur_builds,
+    vercmp,
+)
+from charonte.roles.pkgs.tasks.pkgs import (
+    PacmanLocalGraph,
+    PacmanSizes,
+    PacmanSnapshot,
+    PkgsAllRole,
+    PkgsAurRole,
+    PkgsNativeRole,
+    sync_aur_artifacts,
+)
+
+
+def test_snapshot_parses_sections():
+    output = [
+        "##native_packages",
+        "base",
+        "git",
+        "##native_dependencies",
+        "glibc",
+        "##aur_packages",
+        "yay",
+        "##aur_dependencies",
+        "##aur_versions",
+        "yay 12.4.2-1",
+        "##boot_mode",
+        "UEFI",
+    ]
+
+    snapshot = PacmanSnapshot().process(output)
+
+    assert snapshot["native_packages"] == ["base", "git"]
+    assert snapshot["native_dependencies"] == ["glibc"]
+    assert snapshot["aur_packages"] == ["yay"]
+    assert snapshot["aur_dependencies"] == []
+    assert snapshot["aur_versions"] == {"yay": "12.4.2-1"}
+    assert snapshot["boot_mode"] == "UEFI"
+
+
+def test_get_context_uses_a_single_fact(monkeypatch):
+    monkeypatch.setenv("CHARONTE_NO_FACT_CACHE", "1")
+    mock_host = Mock()
+    mock_host.get_fact.return_value = {
+        "native_packages": ["base", "grub", "vim"],
+        "native_dependencies": [],
+        "aur_packages": [],
+        "aur_dependencies": [],
+        "boot_mode": "BIOS",
+    }
+    chobolo = {"packages": ["vim"], "baseOverride": ["base"], "bootloader": "grub"}
+
+    context = PkgsAllRole().get_context(None, mock_host, chobolo)
+
+    assert mock_host.get_fact.call_count == 1
+    assert context["native_packages"] == ["base", "grub", "vim"]
+    assert context["boot_mode"] == "BIOS"
+    assert context["packages"] == ["vim"]
+
+
+def test_get_context_reuses_cached_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHARONTE_CACHE_DIR", str(tmp_path))
+    snapshot = {
+        "native_packages": ["base", "grub"],
+        "native_dependencies": [],
+        "aur_packages": [],
+        "aur_dependencies": [],
+        "boot_mode": "BIOS",
+    }
+    chobolo = {"baseOverride": ["base"], "bootloader": "grub"}
+    mock_host = Mock()
+    mock_host.name = "host-a"
+    mock_host.get_fact.side_effect = ["fingerprint", snapshot]
+
+    PkgsAllRole().get_context(None, mock_host, chobolo)
+
+    mock_host.get_fact.reset_mock()
+    mock_host.get_fact.side_effect = ["fingerprint"]
+    context = PkgsAllRole().get_context(None, mock_host, chobolo)
+
+    assert mock_host.get_fact.call_count == 1
+    assert context["native_packages"] == ["base", "grub"]
+
+
+def test_native_delta_resolves_groups_and_provides():
+    necessaries = ["base", "grub"]
+    context = {
+        "baseOverride": necessaries,
+        "packages": ["xorg", "sh"],
+        "bootloader": "grub",
+        "native_packages": ["base", "grub", "xorg-server", "xorg-xinit"],
+        "native_dependencies": ["bash"],
+        "resolved_native": {
+            "xorg": {"provider": None, "members": ["xorg-server", "xorg-xinit"]},
+            "sh": {"provider": "bash", "members": []},
+        },
+    }
+
+    delta = PkgsAllRole().delta(context)
+
+    assert not delta.to_add
+    assert not delta.to_remove
+
+
+def test_native_delta_keeps_partially_installed_groups():
+    context = {
+        "baseOverride": ["base", "grub"],
+        "packages": ["xorg"],
+        "bootloader": "grub",
+        "native_packages": ["base", "grub", "xorg-server"],
+        "resolved_native": {
+            "xorg": {"provider": None, "members": ["xorg-server", "xorg-xinit"]},
+        },
+    }
+
+    delta = PkgsAllRole().delta(context)
+
+    assert delta.to_add["native"] == ["xorg"]
+    assert not delta.to_remove
+
+
+def test_aur_builds_are_ordered_by_dependency():
+    metadata = {
+        "app": {"Name": "app", "PackageBase": "app", "Depends": ["libfoo>=1.0"]},
+        "libfoo": {
+            "Name": "libfoo",
+            "PackageBase": "libfoo",
+            "MakeDepends": ["cmake"],
+        },
+        "tool": {"Name": "tool", "PackageBase": "tool", "Depends": ["glibc"]},
+    }
+
+    build = plan_aur_builds(["app", "tool"], metadata, {"glibc"})
+
+    assert build["levels"] == [["libfoo", "tool"], ["app"]]
+    assert build["install_after"] == [["libfoo"], []]
+    assert build["repo_deps"] == ["cmake"]
+    assert build["make_deps"] == ["cmake"]
+
+
+def test_split_packages_of_a_target_are_installed_as_dependencies():
+    metadata = {
+        "foo": {"Name": "foo", "PackageBase": "foo", "Depends": ["libfoo"]},
+        "libfoo": {"Name": "libfoo", "PackageBase": "foo"},
+    }
+
+    build = plan_aur_builds(["foo"], metadata, set())
+
+    assert build["levels"] == [["foo"]]
+    assert build["install_after"] == [["libfoo"]]
+
+
+def test_aur_build_falls_back_without_metadata():
+    assert plan_aur_builds(["app"], {}, set()) is None
+
+
+def test_artifact_store_lookup(tmp_path):
+    store = AurArtifactStore.from_options({"path": str(tmp_path)})
+    key = store.key("libfoo", "1:2.0-1", "x86_64", "0123456789abcdef0123")
+    filename = store.filename("libfoo", "1:2.0-1", "x86_64")
+
+    assert key == "libfoo/1_2.0-1-x86_64-0123456789abcdef"
+    assert not store.has(key, [filename])
+
+    (tmp_path / key).mkdir(parents=True)
+    (tmp_path / key / filename).touch()
+
+    assert store.has(key, [filename])
+
+
+def test_prebuilt_artifacts_skip_build_dependencies():
+    metadata = {
+        "libfoo": {
+            "Name": "libfoo",
+            "PackageBase": "libfoo",
+            "MakeDepends": ["cmake"],
+        },
+    }
+
+    build = plan_aur_builds(["libfoo"], metadata, set(), prebuilt={"libfoo"})
+
+    assert build["levels"] == [["libfoo"]]
+    assert build["repo_deps"] == []
+
+
+@pytest.mark.parametrize(
+    "a, b, expected",
+    [
+        ("1.0-1", "1.0-2", -1),
+        ("1.0.1-1", "1.0-1", 1),
+        ("1:1.0-1", "2.0-1", 1),
+        ("1.0a", "1.0", -1),
+        ("2.0", "10.0", -1),
+        ("1.01", "1.1", 0),
+    ],
+)
+def test_vercmp(a, b, expected):
+    assert vercmp(a, b) == expected
+
+
+def test_aur_delta_schedules_only_outdated_packages():
+    context = {
+        "aurPackages": ["fresh", "stale", "tool-git", "other-git"],
+        "aurBuild": {"upgrade": True},
+        "aur_packages": ["fresh", "stale", "tool-git", "other-git"],
+        "aur_versions": {
+            "fresh": "2.0-1",
+            "stale": "1.0-1",
+            "tool-git": "r10.abc-1",
+            "other-git": "r3.def-1",
+        },
+        "aur_metadata": {
+            "fresh": {"Name": "fresh", "Version": "2.0-1"},
+            "stale": {"Name": "stale", "Version": "1.1-1"},
+            "tool-git": {"Name": "tool-git", "Version": "r1.aaa-1"},
+            "other-git": {"Name": "other-git", "Version": "r1.aaa-1"},
+        },
+        "aur_vcs_outdated": ["other-git"],
+    }
+
+    delta = PkgsAurRole().delta(context)
+
+    assert delta.to_add["aur"] == ["other-git", "stale"]
+    assert delta.metadata["aur_outdated"] == ["other-git", "stale"]
+
+
+def test_local_graph_predicts_the_removal_cascade():
+    output = [
+        "##",
+        "%NAME%",
+        "app",
+        "%SIZE%",
+        "100",
+        "%DEPENDS%",
+        "libfoo>=1.0",
+        "sh",
+        "##",
+        "%NAME%",
+        "plugin",
+        "%SIZE%",
+        "10",
+        "%REASON%",
+        "1",
+        "%DEPENDS%",
+        "app",
+        "##",
+        "%NAME%",
+        "libfoo",
+        "%SIZE%",
+        "50",
+        "%REASON%",
+        "1",
+        "##",
+        "%NAME%",
+        "bash",
+        "%SIZE%",
+        "5",
+        "%REASON%",
+        "1",
+        "%PROVIDES%",
+        "sh",
+        "##",
+        "%NAME%",
+        "zsh",
+        "%SIZE%",
+        "5",
+        "%DEPENDS%",
+        "sh",
+    ]
+    context = {
+        "baseOverride": ["zsh"],
+        "native_packages": ["app", "zsh"],
+        "native_dependencies": ["plugin", "libfoo", "bash"],
+        "local_graph": PacmanLocalGraph().process(output),
+    }
+
+    delta = PkgsNativeRole().delta(context)
+
+    assert delta.to_remove["native"] == ["app"]
+    assert delta.metadata["removal_impact"] == {
+        "packages": ["app", "libfoo", "plugin"],
+        "cascaded": ["libfoo", "plugin"],
+        "freed_bytes": 160,
+    }
+
+
+def test_native_delta_reconciles_install_reasons():
+    graph = {
+        "zsh": {"size": 5, "explicit": True, "depends": ["sh"], "provides": []},
+        "bash": {"size": 5, "explicit": True, "depends": [], "provides": ["sh"]},
+        "nano": {"size": 1, "explicit": True, "depends": [], "provides": []},
+        "git": {"size": 9, "explicit": False, "depends": [], "provides": []},
+    }
+    context = {
+        "baseOverride": ["zsh", "git"],
+        "native_packages": ["zsh", "bash", "nano"],
+        "native_dependencies": ["git"],
+        "local_graph": graph,
+    }
+
+    delta = PkgsNativeRole().delta(context)
+
+    assert delta.to_add["native_asexplicit"] == ["git"]
+    assert delta.to_add["native_asdeps"] == ["bash"]
+    assert delta.to_remove["native"] == ["nano"]
+
+
+def test_reason_changes_invalidate_the_cache_the_facts_came_from(monkeypatch):
+    get_fact_cache = Mock()
+    monkeypatch.setattr(pkgs, "get_fact_cache", get_fact_cache)
+    monkeypatch.setattr(pkgs.pacman, "add_op", Mock())
+    options = {"enabled": True, "ttl": 60}
+    context = {
+        "baseOverride": ["git"],
+        "native_packages": [],
+        "native_dependencies": ["git"],
+        "local_graph": {
+            "git": {"size": 9, "explicit": False, "depends": [], "provides": []},
+        },
+        "factCache": options,
+    }
+    mock_host = Mock()
+    mock_host.name = "host-a"
+    mock_host.op_hash_order = []
+
+    role = PkgsNativeRole()
+    role._plan_native(Mock(), mock_host, role.delta(context))
+
+    assert [c.args for c in get_fact_cache.call_args_list] == [
+        ("pkgs", options),
+        ("pkgs-graph", options),
+    ]
+    get_fact_cache.return_value.invalidate.assert_called_with("host-a")
+
+
+def test_size_estimate_annotates_the_delta():
+    context = {
+        "estimateSizes": True,
+        "baseOverride": ["base", "vim"],
+        "native_packages": ["base"],
+        "native_sizes": {
+            "vim": {"download": 1843200, "installed": 4939776},
+            "gpm": {"download": 100, "installed": 524288},
+        },
+    }
+
+    delta = PkgsAllRole().delta(context)
+    estimate = delta.metadata["size_estimate"]
+
+    assert estimate["download_bytes"] == 1843300
+    assert estimate["installed_change_bytes"] == 5464064
+    assert estimate["unestimated"] == []
+    assert PkgsAllRole._get_size_messages(delta) == [
+        "Download: 1.8 MiB, installed size change: 5.2 MiB"
+    ]
+
+
+def test_unsized_packages_are_left_out_of_the_totals():
+    sizes = PacmanSizes().process(
+        [
+            "download vim 1843200",
+            "download bogus -",
+            "installed vim 4.71 MiB",
+        ]
+    )
+    assert sizes["bogus"] == {"download": None, "installed": None}
+    context = {
+        "estimateSizes": True,
+        "baseOverride": ["base", "vim", "bogus"],
+        "native_packages": ["base"],
+        "native_sizes": sizes,
+    }
+
+    delta = PkgsAllRole().delta(context)
+    estimate = delta.metadata["size_estimate"]
+
+    assert estimate["download_bytes"] == 1843200
+    assert estimate["unknown"] == ["bogus"]
+    assert PkgsAllRole._get_size_messages(delta)[-1] == (
+        "Packages pacman could not size, left out of the totals: bogus"
+    )
+
+
+def test_truncated_aur_responses_fall_back_to_the_helper(monkeypatch):
+    class Truncated:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def read(self, *args):
+            raise http.client.IncompleteRead(b"{")
+
+    monkeypatch.setenv("CHARONTE_NO_FACT_CACHE", "1")
+    monkeypatch.setattr(aur, "_rpc_memo", {})
+    monkeypatch.setattr(aur.urllib.request, "urlopen", lambda *a, **k: Truncated())
+
+    with pytest.raises(OSError):
+        aur.fetch_aur_info(["yay"])
+
+    context = {"aurBuild": True, "aurPackages": ["yay"]}
+    PkgsAurRole()._get_aur_metadata_context(Mock(), context)
+
+    assert context["aur_metadata"] == {}
+
+
+def test_artifacts_are_looked_up_when_the_op_runs(tmp_path):
+    store = AurArtifactStore(str(tmp_path), url="http://cache.lan/aur")
+    key = store.key("libfoo", "2.0-1", "x86_64", "0123456789abcdef")
+    artifact = {"key": key, "files": {"libfoo": "libfoo-2.0-1-x86_64.pkg.tar.zst"}}
+    options = {"path": str(tmp_path), "url": "http://cache.lan/aur"}
+
+    commands = sync_aur_artifacts._inner(options, {"libfoo": artifact})
+    assert next(commands) == build_level_command(["libfoo"])
+    assert "ln -f" in next(commands)
+
+    # Another host published the artifacts in the meantime.
+    (tmp_path / key).mkdir(parents=True)
+    (tmp_path / key / "libfoo-2.0-1-x86_64.pkg.tar.zst").touch()
+
+    commands = list(sync_aur_artifacts._inner(options, {"libfoo": artifact}))
+    assert len(commands) == 2
+    assert commands[0].startswith("curl -fsSL")
+    assert "http://cache.lan/aur/libfoo/" in commands[0]
+    assert "lists/libfoo" in commands[1]
@@ -0,0 +1,247 @@
+from unittest.mock import Mock
+
+from charonte.roles.services.tasks import services
+from charonte.roles.services.tasks.services import (
+    ServiceIds,
+    ServiceIndex,
+    ServicesRole,
+    ServicesSnapshot,
+    is_blacklisted,
+)
+
+SNAPSHOT_OUTPUT = [
+    "##files",
+    "bluetooth.service enabled disabled",
+    "docker.service disabled disabled",
+    "getty@.service enabled enabled",
+    "systemd-timesyncd.service enabled enabled",
+    "unit-status-mail.service enabled disabled",
+    "##units",
+    "bluetooth.service loaded active running Bluetooth service",
+    "unit-status-mail.service loaded failed failed Unit Status Mailer",
+    "user@1000.service loaded active running User Manager for UID 1000",
+]
+
+
+def test_get_context_uses_a_single_snapshot():
+    mock_host = Mock()
+    mock_host.get_fact.return_value = ServicesSnapshot().process(SNAPSHOT_OUTPUT)
+
+    context = ServicesRole().get_context(None, mock_host, {"services": []})
+
+    mock_host.get_fact.assert_called_once_with(ServicesSnapshot)
+    assert sorted(context["enabled_services"]) == [
+        "bluetooth.service",
+        "systemd-timesyncd.service",
+        "unit-status-mail.service",
+    ]
+    assert "user@1000.service" not in context["all_services"]
+    assert context["service_states"]["unit-status-mail.service"] == {
+        "state": "enabled",
+        "active": "failed",
+        "sub": "failed",
+        "type": None,
+        "on_demand": False,
+    }
+
+
+def test_batch_mode_applies_the_delta_in_one_command(monkeypatch):
+    add_op = Mock()
+    monkeypatch.setattr(services, "add_op", add_op)
+    context = {
+        "all_services": ["docker.service", "cups.service", "nginx.service"],
+        "enabled_services": ["nginx.service"],
+        "declared_services": [
+            {"name": "docker"},
+            {"name": "cups", "running": False},
+        ],
+        "batchServices": True,
+    }
+
+    role = ServicesRole()
+    role.plan(None, None, role.delta(context))
+
+    add_op.assert_called_once()
+    command = add_op.call_args.kwargs["commands"][0].splitlines()
+    assert command[:5] == [
+        "set -e",
+        "systemctl enable cups.service docker.service",
+        "systemctl disable nginx.service",
+        "systemctl start --no-block docker.service",
+        "systemctl stop --no-block cups.service nginx.service",
+    ]
+
+
+def test_dense_services_expand_from_the_prefix_index():
+    index = ServiceIndex(
+        [
+            "libvirt-guests.service",
+            "libvirtd.service",
+            "libvirt-template@.service",
+            "libvirt-initrd.service",
+            "lightdm.service",
+            "libinput.service",
+        ]
+    )
+
+    assert index.with_prefix("libvirt") == [
+        "libvirt-guests.service",
+        "libvirtd.service",
+    ]
+    assert index.with_prefix("zzz") == []
+    assert is_blacklisted("dbus.service")
+    assert not is_blacklisted("dbus-org.service")
+
+
+def test_delta_follows_runtime_state():
+    states = {
+        "docker.service": {"state": "enabled", "active": "active", "sub": "running"},
+        "cups.service": {"state": "enabled", "active": "failed", "sub": "failed"},
+        "colord.service": {"state": "disabled", "active": None, "sub": None},
+        "nginx.service": {"state": "enabled", "active": "inactive", "sub": "dead"},
+    }
+    context = {
+        "all_services": list(states),
+        "enabled_services": ["docker.service", "cups.service", "nginx.service"],
+        "service_states": states,
+        "declared_services": [
+            {"name": "docker"},
+            {"name": "cups"},
+            {"name": "colord", "running": False, "on_boot": False},
+        ],
+    }
+
+    delta = ServicesRole().delta(context)
+
+    assert delta.to_add["services"] == ["cups.service"]
+    assert delta.metadata["divergence"]["cups.service"] == {
+        "enabled": False,
+        "running": True,
+    }
+    assert delta.to_remove["services"] == ["nginx.service"]
+    assert delta.metadata["divergence"]["nginx.service"]["running"] is False
+
+
+def test_aliases_resolve_to_canonical_units_once(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHARONTE_CACHE_DIR", str(tmp_path))
+    snapshot = ServicesSnapshot().process(
+        [
+            "##files",
+            "gdm.service enabled disabled",
+            "display-manager.service alias -",
+            "##units",
+            "gdm.service loaded active running GNOME Display Manager",
+        ]
+    )
+    ids = ServiceIds().process(
+        ["Id=gdm.service", "Names=gdm.service display-manager.service", ""]
+    )
+
+    def get_fact(fact, **kwargs):
+        return snapshot if fact is ServicesSnapshot else ids
+
+    mock_host = Mock()
+    mock_host.name = "host-a"
+    mock_host.get_fact.side_effect = get_fact
+    chobolo = {"services": [{"name": "display-manager"}]}
+
+    role = ServicesRole()
+    context = role.get_context(None, mock_host, chobolo)
+    mock_host.get_fact.assert_any_call(ServiceIds, names=["display-manager.service"])
+    delta = role.delta(context)
+
+    assert context["service_ids"] == {"display-manager.service": "gdm.service"}
+    assert not delta.to_add
+    assert not delta.to_remove
+
+    mock_host.get_fact.reset_mock()
+    assert role.get_context(None, mock_host, chobolo)["service_ids"] == {
+        "display-manager.service": "gdm.service"
+    }
+    mock_host.get_fact.assert_called_once_with(ServicesSnapshot)
+
+
+def test_idle_on_demand_units_are_not_restarted():
+    snapshot = ServicesSnapshot().process(
+        [
+            "##files",
+            "cups.service enabled disabled",
+            "cups.socket enabled enabled",
+            "backup.service enabled disabled",
+            "crashy.service enabled disabled",
+            "##units",
+            "cups.service loaded inactive dead CUPS Scheduler",
+            "backup.service loaded inactive dead Nightly backup",
+            "crashy.service loaded failed failed Crashy",
+            "##props",
+            "Id=cups.service",
+            "Type=notify",
+            "TriggeredBy=cups.socket cups.path",
+            "BusName=",
+            "",
+            "Id=backup.service",
+            "Type=oneshot",
+            "TriggeredBy=",
+            "BusName=",
+            "",
+            "Id=crashy.service",
+            "Type=simple",
+            "TriggeredBy=",
+            "BusName=",
+        ]
+    )
+    assert snapshot["cups.service"]["on_demand"] is True
+    context = {
+        "all_services": list(snapshot),
+        "enabled_services": ["cups.service", "backup.service", "crashy.service"],
+        "service_states": snapshot,
+        "declared_services": [
+            {"name": "cups"},
+            {"name": "backup"},
+            {"name": "crashy"},
+        ],
+    }
+
+    delta = ServicesRole().delta(context)
+
+    assert delta.to_add["services"] == ["crashy.service"]
+
+
+def test_stopped_dbus_daemons_are_started_unless_bus_activated():
+    snapshot = ServicesSnapshot().process(
+        [
+            "##files",
+            "NetworkManager.service enabled disabled",
+            "nm-dispatcher.service disabled disabled",
+            "##units",
+            "NetworkManager.service loaded inactive dead Network Manager",
+            "nm-dispatcher.service loaded inactive dead Network Manager Script",
+            "##props",
+            "Id=NetworkManager.service",
+            "Type=dbus",
+            "TriggeredBy=",
+            "BusName=org.freedesktop.NetworkManager",
+            "",
+            "Id=nm-dispatcher.service",
+            "Type=dbus",
+            "TriggeredBy=",
+            "BusName=org.freedesktop.nm_dispatcher",
+            "##dbus",
+            "Name=org.freedesktop.nm_dispatcher",
+        ]
+    )
+    assert snapshot["NetworkManager.service"]["on_demand"] is False
+    assert snapshot["nm-dispatcher.service"]["on_demand"] is True
+    context = {
+        "all_services": list(snapshot),
+        "enabled_services": ["NetworkManager.service"],
+        "service_states": snapshot,
+        "declared_services": [
+            {"name": "NetworkManager"},
+            {"name": "nm-dispatcher", "on_boot": False},
+        ],
+    }
+
+    delta = ServicesRole().delta(context)
+
+    assert delta.to_add["services"] == ["NetworkManager.service"]
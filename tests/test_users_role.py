@@ -0,0 +1,304 @@
+from unittest.mock import Mock
+
+import pytest
+from passlib.hash import sha512_crypt
+
+from charonte.lib.cache import FactCache
+from charonte.roles.users.tasks import passwords
+from charonte.roles.users.tasks.users import (
+    UsersRole,
+    UsersSnapshot,
+    build_sudoers_command,
+    build_users_script,
+)
+
+SNAPSHOT_OUTPUT = [
+    "##passwd",
+    "root:x:0:0:root:/root:/bin/bash",
+    "dex:x:1000:1000::/home/dex:/bin/zsh",
+    "##regular",
+    "dex",
+    "old",
+    "nobody",
+    "##group",
+    "root:x:0:",
+    "dex:x:1000:",
+    "wheel:x:998:dex",
+    "##shadow",
+    "dex:$6$salt$hash",
+    "##sudoers",
+    "99-charonte-dex|ZGV4IEFMTD0oQUxMOkFMTCkgQUxMCg==",
+    "##hostname",
+    "machina",
+]
+
+
+def test_get_context_uses_a_single_snapshot():
+    mock_host = Mock()
+    mock_host.get_fact.return_value = UsersSnapshot().process(SNAPSHOT_OUTPUT)
+
+    chobolo = {"users": [{"name": "dex", "groups": ["wheel"]}, {"name": "root"}]}
+    context = UsersRole().get_context(None, mock_host, chobolo)
+
+    mock_host.get_fact.assert_called_once_with(
+        UsersSnapshot, names=["dex", "root"], groups=["wheel"], _sudo=True
+    )
+    assert context["existing_users"] == {"dex", "old"}
+    assert set(context["all_users_info"]) == {"dex", "root"}
+    assert context["system_users"] == {"root"}
+    assert context["all_users_info"]["dex"]["groups"] == ["wheel"]
+    assert context["all_users_info"]["dex"]["shell"] == "/bin/zsh"
+    assert context["shadow_hashes"] == {"dex": "$6$salt$hash"}
+    assert context["managed_sudo_files"] == {
+        "99-charonte-dex": "dex ALL=(ALL:ALL) ALL\n"
+    }
+    assert context["current_hostname"] == "machina"
+
+
+def test_get_context_fails_with_the_snapshot():
+    mock_host = Mock()
+    mock_host.get_fact.side_effect = Exception("no sudo")
+
+    with pytest.raises(Exception, match="no sudo"):
+        UsersRole().get_context(None, mock_host, {})
+
+    mock_host.get_fact.side_effect = None
+    mock_host.get_fact.return_value = {}
+
+    with pytest.raises(RuntimeError):
+        UsersRole().get_context(None, mock_host, {})
+
+
+def test_password_is_verified_once_per_run(monkeypatch):
+    existing_hash = sha512_crypt.hash("secret", rounds=1000)
+    verify = Mock(wraps=passwords._verify_hash)
+    monkeypatch.setattr(passwords, "_verify_hash", verify)
+    context = {
+        "users": [{"name": "dex", "shell": "zsh"}],
+        "existing_users": {"dex"},
+        "all_users_info": {"dex": {"shell": "/bin/bash", "home": "/home/dex"}},
+        "shadow_hashes": {"dex": existing_hash},
+        "secrets": {"user_secrets": {"dex": {"password": "secret"}}},
+    }
+
+    delta = UsersRole().delta(context)
+
+    assert delta.to_add["users"] == ["dex"]
+    assert delta.metadata["user_hashes"] == {"dex": existing_hash}
+    assert "user_pass" not in delta.metadata
+    assert verify.call_count == 1
+
+
+def test_verdicts_persist_as_keyed_digests(tmp_path, monkeypatch):
+    existing_hash = sha512_crypt.hash("secret", rounds=1000)
+    verify = Mock(wraps=passwords._verify_hash)
+    monkeypatch.setattr(passwords, "_verify_hash", verify)
+    monkeypatch.setattr(passwords, "_verdicts", {})
+
+    monkeypatch.setenv(passwords.CONFIG_DIR_ENV, str(tmp_path / "config"))
+    cache = FactCache("users-verify", root=tmp_path / "cache")
+    assert passwords.PasswordVerifier(cache).verify("secret", existing_hash)
+
+    monkeypatch.setattr(passwords, "_verdicts", {})
+    assert passwords.PasswordVerifier(cache).verify("secret", existing_hash)
+
+    assert verify.call_count == 1
+    stored = "".join(path.read_text() for path in cache.directory.glob("*.json"))
+    assert "secret" not in stored
+    assert existing_hash not in stored
+    # The key never sits next to the verdicts it would let anyone check.
+    assert not list(cache.directory.glob("*.key"))
+    assert (tmp_path / "config" / "verify.key").stat().st_mode & 0o077 == 0
+
+
+@pytest.mark.parametrize(
+    "handler",
+    [
+        sha512_crypt.using(rounds=1000),
+        passwords.sha256_crypt.using(rounds=1000),
+        passwords.md5_crypt,
+    ],
+)
+def test_verification_dispatches_on_the_hash_scheme(handler):
+    hashed = handler.hash("secret")
+
+    assert passwords._verify_hash("secret", hashed)
+    assert not passwords._verify_hash("other", hashed)
+
+
+def test_yescrypt_hashes_are_verified_with_libc(monkeypatch):
+    yescrypt = "$y$j9T$abcdefghijklmnopqrstuv$hash"
+    libc = Mock(side_effect=lambda password, setting: yescrypt)
+    monkeypatch.setattr(passwords, "_libc_crypt", libc)
+
+    assert passwords._verify_hash("secret", yescrypt)
+    libc.assert_called_once_with("secret", yescrypt)
+
+    rehashed = passwords.hash_password("secret", like=yescrypt)
+
+    assert rehashed == yescrypt
+    setting = libc.call_args.args[1]
+    assert setting.startswith("$y$j9T$") and len(setting) == len("$y$j9T$") + 22
+
+
+YESCRYPT_SECRET = (
+    "$y$j9T$cUavjXGb6jTWaTFl4wMBz/$Fw6SGaFyjqXtLKLp3NHM70vpbEAddynkwLuwyStkVO."
+)
+
+
+@pytest.mark.skipif(
+    passwords._libc_crypt("secret", YESCRYPT_SECRET) is None,
+    reason="libcrypt without yescrypt",
+)
+def test_real_yescrypt_hashes_are_verified_and_kept():
+    assert passwords._verify_hash("secret", YESCRYPT_SECRET)
+    assert not passwords._verify_hash("other", YESCRYPT_SECRET)
+
+    rehashed = passwords.hash_password("secret", like=YESCRYPT_SECRET)
+
+    assert rehashed.startswith("$y$j9T$") and rehashed != YESCRYPT_SECRET
+    assert passwords._verify_hash("secret", rehashed)
+
+
+def test_bulk_mode_applies_users_with_one_script():
+    context = {
+        "bulkUsers": True,
+        "users": [
+            {"name": "dex", "groups": ["wheel", "video"]},
+            {"name": "machina", "shell": "zsh"},
+        ],
+        "existing_users": {"dex", "old"},
+        "existing_groups": {"wheel"},
+        "all_users_info": {"dex": {"shell": "/bin/bash", "home": "/home/dex"}},
+        "shadow_hashes": {"dex": "$6$salt$hash"},
+        "secrets": {
+            "user_secrets": {
+                "dex": {"password": "$6$salt$new"},
+                "machina": {"password": "$6$salt$other"},
+            }
+        },
+    }
+    delta = UsersRole().delta(context)
+
+    assert delta.metadata["create_groups"] == ["video"]
+    assert delta.metadata["new_users"] == ["machina"]
+
+    script = build_users_script(
+        users_to_remove=delta.to_remove["users"],
+        users=delta.metadata["enforce_users"],
+        new_users=delta.metadata["new_users"],
+        groups=delta.metadata["create_groups"],
+        hashes=delta.metadata["user_hashes"],
+    )
+
+    assert script.splitlines() == [
+        "set -e",
+        "getent group video >/dev/null || groupadd video",
+        "userdel old",
+        "usermod -d /home/dex -s /bin/bash -G wheel,video dex",
+        '[ -d /home/dex ] || install -d -m 0700 -o dex -g "$(id -gn dex)" /home/dex',
+        "useradd -m -d /home/machina -s /bin/zsh machina",
+        "chpasswd -e <<'CHARONTE_PASSWORDS'",
+        "dex:$6$salt$new",
+        "machina:$6$salt$other",
+        "CHARONTE_PASSWORDS",
+    ]
+
+
+def test_sudo_rules_are_validated_together_before_the_swap():
+    command = build_sudoers_command(
+        {"99-charonte-dex": "dex ALL=(ALL:ALL) ALL\n", "99-charonte-ana": "ana\n"},
+        ["99-charonte-old"],
+    )
+    lines = command.splitlines()
+
+    assert lines[1] == "stage=$(mktemp -d /etc/sudoers.d/.charonte.XXXXXX)"
+    assert [line for line in lines if "visudo" in line] == [
+        'visudo -c -q -f "$stage/.check"'
+    ]
+    check = lines.index('visudo -c -q -f "$stage/.check"')
+    assert lines[check + 1 :] == [
+        'mv -f "$stage"/99-charonte-ana /etc/sudoers.d/99-charonte-ana',
+        'mv -f "$stage"/99-charonte-dex /etc/sudoers.d/99-charonte-dex',
+        "rm -f /etc/sudoers.d/99-charonte-old",
+    ]
+
+
+def test_equivalent_shells_homes_and_primary_groups_converge():
+    context = {
+        "users": [
+            {"name": "dex", "shell": "zsh", "home": "/home/dex/", "groups": ["dex"]},
+            {"name": "ana", "shell": "fish"},
+        ],
+        "existing_users": {"dex", "ana"},
+        "all_users_info": {
+            "dex": {
+                "shell": "/usr/bin/zsh",
+                "home": "/home/dex",
+                "group": "dex",
+                "groups": [],
+            },
+            "ana": {"shell": "/usr/local/bin/fish", "home": "/home/ana", "groups": []},
+        },
+        "login_shells": ["/bin/zsh", "/usr/bin/zsh", "/usr/local/bin/fish"],
+    }
+
+    delta = UsersRole().delta(context)
+
+    assert "users" not in delta.to_add
+
+
+def test_parallel_batches_share_one_pool_and_keep_job_order(monkeypatch):
+    monkeypatch.setattr(passwords, "_pool", None)
+    monkeypatch.setattr(passwords, "_pool_workers", 0)
+    jobs = [(f"$y$j9T$salt{index}$hash",) for index in range(6)]
+
+    assert passwords.run_parallel(passwords.hash_scheme, jobs, workers=2) == ["y"] * 6
+    pool = passwords._pool
+    assert pool is not None
+    assert passwords.run_parallel(passwords.hash_scheme, jobs, workers=2) == ["y"] * 6
+    assert passwords._pool is pool
+
+    # Asking for more workers restarts the pool, asking for fewer reuses it.
+    assert passwords.run_parallel(passwords.hash_scheme, jobs, workers=3) == ["y"] * 6
+    pool = passwords._pool
+    assert passwords._pool_workers == 3
+    assert passwords.run_parallel(passwords.hash_scheme, jobs, workers=2) == ["y"] * 6
+    assert passwords._pool is pool
+
+    # Callables that cannot be sent to the workers run serially instead.
+    doubled = passwords.run_parallel(lambda n: n * 2, [(1,), (2,), (3,), (4,)], 2)
+    assert doubled == [2, 4, 6, 8]
+    assert passwords._pool is pool
+    passwords._reset_pool()
+
+
+def test_verifications_are_prefetched_in_one_batch(monkeypatch):
+    batches = []
+
+    def run_parallel(func, jobs, workers=None):
+        batches.append(jobs)
+        return [func(*job) for job in jobs]
+
+    monkeypatch.setattr(passwords, "run_parallel", run_parallel)
+    monkeypatch.setattr(passwords, "_verdicts", {})
+    hashes = {
+        name: sha512_crypt.using(rounds=1000).hash(name) for name in ("dex", "ana")
+    }
+    context = {
+        "users": [{"name": "dex"}, {"name": "ana"}],
+        "existing_users": {"dex", "ana"},
+        "all_users_info": {
+            name: {"shell": "/bin/bash", "home": f"/home/{name}"} for name in hashes
+        },
+        "shadow_hashes": hashes,
+        "secrets": {
+            "user_secrets": {"dex": {"password": "dex"}, "ana": {"password": "new"}}
+        },
+    }
+
+    delta = UsersRole().delta(context)
+
+    assert batches[0] == [("dex", hashes["dex"]), ("new", hashes["ana"])]
+    assert batches[1] == [("new", None)]
+    assert delta.to_add["users"] == ["ana"]